@@ -27,7 +27,7 @@ class TestCase:
     def run(self):
         pass
 
-def prepare(side: Side, stub: SideStub):
+def prepare(side: Side, stub: SideStub, qp_type = message_pb2.CreateQpRequest.RC):
     dev_name = side.dev_name()
     dev_name = dev_name if dev_name else ''
     response = stub.OpenDevice(
@@ -61,7 +61,7 @@ def prepare(side: Side, stub: SideStub):
     mr_id = response.mr_id
 
     response: message_pb2.CreateQpResponse = stub.CreateQp(
-        message_pb2.CreateQpRequest(pd_id=pd_id, qp_type=0, cq_id=cq_id))
+        message_pb2.CreateQpRequest(pd_id=pd_id, qp_type=qp_type, cq_id=cq_id))
     qp_id = response.qp_id
     qp_num = response.qp_num
 
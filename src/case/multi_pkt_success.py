@@ -0,0 +1,99 @@
+from proto.side_pb2_grpc import SideStub
+from .base import TestCase, SideInfo, prepare
+from config import Side
+from proto import message_pb2
+import threading
+import time
+
+# Both sides use 256 bytes path MTU, the data length spans multiple packets and is not 4-byte aligned
+PMTU = 256
+DATA_LEN = 1001
+DATA = bytes([i % 256 for i in range(DATA_LEN)])
+PKT_NUM = (DATA_LEN + PMTU - 1) // PMTU
+
+class MultiPktSuccess(TestCase):
+    def __init__(self, stub1: SideStub, stub2: SideStub, side1: Side, side2: Side):
+        TestCase.__init__(self, stub1, stub2, side1, side2)
+
+    def run(self):
+        for passive_side, active_side in [(recv_side, send_side), (be_write_side, write_side), (be_read_side, read_side)]:
+            side_info_1 = prepare(self.side1, self.stub1)
+            side_info_2 = prepare(self.side2, self.stub2)
+
+            th1 = threading.Thread(target=passive_side, args=(
+                side_info_1, side_info_2, self.side1, self.stub1))
+            th2 = threading.Thread(target=active_side, args=(
+                side_info_2, side_info_1, self.side2, self.stub2))
+
+            th1.start()
+            th2.start()
+
+            th1.join()
+            th2.join()
+
+
+def connect(self_info: SideInfo, other_info: SideInfo, side: Side, stub: SideStub):
+    stub.ConnectQp(message_pb2.ConnectQpRequest(
+        dev_name=self_info.dev_name, qp_id=self_info.qp_id, access_flag=15, gid_idx=side.gid_idx(), ib_port_num=side.ib_port(), remote_qp_num=other_info.qp_num, remote_lid=other_info.lid, remote_gid=other_info.gid, timeout=14, retry=7, rnr_retry=7))
+
+def check_data(self_info: SideInfo, stub: SideStub, op_name):
+    resp = stub.LocalCheckMem(message_pb2.LocalCheckMemRequest(
+        mr_id=self_info.mr_id, offset=0, len=DATA_LEN, expected=DATA))
+
+    if resp.same:
+        print("Multi-packet {} value is read correctly".format(op_name))
+    else:
+        print("Multi-packet {} value is NOT read correctly".format(op_name))
+
+
+def send_side(self_info: SideInfo, other_info: SideInfo, side: Side, stub: SideStub):
+    connect(self_info, other_info, side, stub)
+    stub.LocalWrite(message_pb2.LocalWriteRequest(
+        mr_id=self_info.mr_id, offset=0, len=DATA_LEN, content=DATA))
+    time.sleep(1)
+    stub.RemoteSend(message_pb2.RemoteSendRequest(addr=self_info.addr, len=DATA_LEN, lkey=self_info.lkey,
+                    qp_id=self_info.qp_id, cq_id=self_info.cq_id))
+    # One ACK for the last packet
+    stub.RecvPkt(message_pb2.RecvPktRequest(
+        wait_for_retry=False, has_cqe=True, qp_id=self_info.qp_id))
+
+def recv_side(self_info: SideInfo, other_info: SideInfo, side: Side, stub: SideStub):
+    connect(self_info, other_info, side, stub)
+    stub.LocalRecv(message_pb2.LocalRecvRequest(addr=self_info.addr, len=DATA_LEN,
+                   lkey=self_info.lkey, qp_id=self_info.qp_id, cq_id=self_info.cq_id))
+    time.sleep(2)
+    check_data(self_info, stub, 'send')
+
+
+def write_side(self_info: SideInfo, other_info: SideInfo, side: Side, stub: SideStub):
+    connect(self_info, other_info, side, stub)
+    stub.LocalWrite(message_pb2.LocalWriteRequest(
+        mr_id=self_info.mr_id, offset=0, len=DATA_LEN, content=DATA))
+    time.sleep(1)
+    stub.RemoteWrite(message_pb2.RemoteWriteRequest(addr=self_info.addr, len=DATA_LEN, lkey=self_info.lkey,
+                    remote_addr=other_info.addr, remote_key=other_info.rkey, qp_id=self_info.qp_id, cq_id=self_info.cq_id))
+    # One ACK for the last packet
+    stub.RecvPkt(message_pb2.RecvPktRequest(
+        wait_for_retry=False, has_cqe=True, qp_id=self_info.qp_id))
+
+def be_write_side(self_info: SideInfo, other_info: SideInfo, side: Side, stub: SideStub):
+    connect(self_info, other_info, side, stub)
+    time.sleep(2)
+    check_data(self_info, stub, 'write')
+
+
+def read_side(self_info: SideInfo, other_info: SideInfo, side: Side, stub: SideStub):
+    connect(self_info, other_info, side, stub)
+    time.sleep(1)
+    stub.RemoteRead(message_pb2.RemoteReadRequest(addr=self_info.addr, len=DATA_LEN, lkey=self_info.lkey,
+                    remote_addr=other_info.addr, remote_key=other_info.rkey, qp_id=self_info.qp_id, cq_id=self_info.cq_id))
+    # One read response per PMTU, the read completes with the last one
+    for pkt_idx in range(PKT_NUM):
+        stub.RecvPkt(message_pb2.RecvPktRequest(
+            wait_for_retry=False, has_cqe=(pkt_idx == PKT_NUM - 1), qp_id=self_info.qp_id))
+    check_data(self_info, stub, 'read')
+
+def be_read_side(self_info: SideInfo, other_info: SideInfo, side: Side, stub: SideStub):
+    connect(self_info, other_info, side, stub)
+    stub.LocalWrite(message_pb2.LocalWriteRequest(
+        mr_id=self_info.mr_id, offset=0, len=DATA_LEN, content=DATA))
@@ -14,56 +14,16 @@ from scapy.packet import Packet, bind_layers, Raw
 from scapy.fields import BitEnumField, ByteEnumField, ByteField, XByteField, \
     ShortField, XShortField, XIntField, XLongField, BitField, XBitField, FCSField
 from scapy.layers.inet import IP, UDP
+from scapy.layers.inet6 import IPv6
 from scapy.layers.l2 import Ether
-from scapy.compat import raw
 from scapy.error import warning
-from zlib import crc32
+from socket import AF_INET, AF_INET6, inet_pton
 import struct
 from scapy.compat import Tuple
 
-_transports = {
-    'RC': 0x00,
-    'UC': 0x20,
-    'RD': 0x40,
-    'UD': 0x60,
-    'CNP': 0x80,
-    'XRC': 0xA0,
-}
-
-_ops = {
-    'SEND_FIRST': 0x00,
-    'SEND_MIDDLE': 0x01,
-    'SEND_LAST': 0x02,
-    'SEND_LAST_WITH_IMMEDIATE': 0x03,
-    'SEND_ONLY': 0x04,
-    'SEND_ONLY_WITH_IMMEDIATE': 0x05,
-    'RDMA_WRITE_FIRST': 0x06,
-    'RDMA_WRITE_MIDDLE': 0x07,
-    'RDMA_WRITE_LAST': 0x08,
-    'RDMA_WRITE_LAST_WITH_IMMEDIATE': 0x09,
-    'RDMA_WRITE_ONLY': 0x0a,
-    'RDMA_WRITE_ONLY_WITH_IMMEDIATE': 0x0b,
-    'RDMA_READ_REQUEST': 0x0c,
-    'RDMA_READ_RESPONSE_FIRST': 0x0d,
-    'RDMA_READ_RESPONSE_MIDDLE': 0x0e,
-    'RDMA_READ_RESPONSE_LAST': 0x0f,
-    'RDMA_READ_RESPONSE_ONLY': 0x10,
-    'ACKNOWLEDGE': 0x11,
-    'ATOMIC_ACKNOWLEDGE': 0x12,
-    'COMPARE_SWAP': 0x13,
-    'FETCH_ADD': 0x14,
-    'RESYNC': 0x15,
-    'SEND_LAST_WITH_INVALIDATE': 0x16,
-    'SEND_ONLY_WITH_INVALIDATE': 0x17,
-}
-
-
-CNP_OPCODE = 0x81
-
-
-def opcode(transport, op):
-    # type: (str, str) -> Tuple[int, str]
-    return (_transports[transport] + _ops[op], '{}_{}'.format(transport, op))
+from roce_codec import CNP_OPCODE, IcrcEngine, _ops, _transports, opcode # shared with the scapy-free codec
+
+_icrc_engine = IcrcEngine()
 
 
 _bth_opcodes = dict([
@@ -191,28 +151,17 @@ class BTH(Packet):
             return self.pack_icrc(0)
         ip = udp.underlayer
         if isinstance(ip, IP):
-            # pseudo-LRH / IP / UDP / BTH / payload
-            pshdr = Raw(b'\xff' * 8) / ip.copy()
-            pshdr.chksum = 0xffff
-            pshdr.ttl = 0xff
-            pshdr.tos = 0xff
-            pshdr[UDP].chksum = 0xffff
-            pshdr[BTH].fecn = 1
-            pshdr[BTH].becn = 1
-            pshdr[BTH].resv6 = 0xff
-            bth = pshdr[BTH].self_build()
-            payload = raw(pshdr[BTH].payload)
-            # add ICRC placeholder just to get the right IP.totlen and
-            # UDP.length
-            icrc_placeholder = b'\xff\xff\xff\xff'
-            pshdr[UDP].payload = Raw(bth + payload + icrc_placeholder)
-            icrc = crc32(raw(pshdr)[:-4]) & 0xffffffff
-            return self.pack_icrc(icrc)
+            icrc_flow = _icrc_engine.flow(inet_pton(AF_INET, ip.src), inet_pton(AF_INET, ip.dst),
+                                          udp.sport, udp.dport, ip.id, int(ip.flags))
+        elif isinstance(ip, IPv6):
+            icrc_flow = _icrc_engine.flow(inet_pton(AF_INET6, ip.src), inet_pton(AF_INET6, ip.dst),
+                                          udp.sport, udp.dport)
         else:
-            # TODO support IPv6
             warning("The underlayer protocol %s is not supported.",
                     ip and ip.name)
             return self.pack_icrc(0)
+        # pseudo-LRH / IP / UDP / BTH / payload, without the ICRC placeholder
+        return self.pack_icrc(icrc_flow.compute(p[:-4]))
 
     # RoCE packets end with ICRC - a 32-bit CRC of the packet payload and
     # pseudo-header. Add the ICRC header if it is missing and calculate its
@@ -296,6 +245,14 @@ class IETH(Packet):
         XIntField("rkey", 0),
     ]
 
+class DETH(Packet): # for UD only
+    name = "DETH"
+    fields_desc = [
+        XIntField("qkey", 0),
+        ByteField("rsvd", 0),
+        XBitField("sqpn", 0, 24),
+    ]
+
 class RETHImmDt(Packet): # for RDMA_WRITE_ONLY_WITH_IMMEDIATE only
     name = "RETHImmdt"
     fields_desc = [
@@ -328,5 +285,8 @@ bind_layers(BTH, RETH, opcode=opcode('RC', 'RDMA_WRITE_FIRST')[0])
 bind_layers(BTH, RETH, opcode=opcode('RC', 'RDMA_WRITE_ONLY')[0])
 #bind_layers(BTH, RETH, opcode=opcode('RC', 'RDMA_WRITE_ONLY_WITH_IMMEDIATE')[0]) this layer binding is not work
 bind_layers(BTH, RETHImmDt, opcode=opcode('RC', 'RDMA_WRITE_ONLY_WITH_IMMEDIATE')[0])
+bind_layers(BTH, DETH, opcode=opcode('UD', 'SEND_ONLY')[0])
+bind_layers(BTH, DETH, opcode=opcode('UD', 'SEND_ONLY_WITH_IMMEDIATE')[0])
+#bind_layers(DETH, ImmDt) only for UD_SEND_ONLY_WITH_IMMEDIATE, this layer binding is not work
 bind_layers(UDP, BTH, dport=4791)
 bind_layers(UDP, BTH, sport=4791)
@@ -0,0 +1,510 @@
+"""
+RoCE v2 header codec without scapy
+
+The headers defined in roce.py are encoded and decoded here with precompiled
+struct formats, which is what the SQ/RQ hot paths use. Headers can still be
+stacked with '/' and looked up with pkt[BTH] like scapy packets, and the
+scapy layers in roce.py are only needed to pretty print a packet.
+"""
+
+import struct
+from zlib import crc32
+
+_transports = {
+    'RC': 0x00,
+    'UC': 0x20,
+    'RD': 0x40,
+    'UD': 0x60,
+    'CNP': 0x80,
+    'XRC': 0xA0,
+}
+
+_ops = {
+    'SEND_FIRST': 0x00,
+    'SEND_MIDDLE': 0x01,
+    'SEND_LAST': 0x02,
+    'SEND_LAST_WITH_IMMEDIATE': 0x03,
+    'SEND_ONLY': 0x04,
+    'SEND_ONLY_WITH_IMMEDIATE': 0x05,
+    'RDMA_WRITE_FIRST': 0x06,
+    'RDMA_WRITE_MIDDLE': 0x07,
+    'RDMA_WRITE_LAST': 0x08,
+    'RDMA_WRITE_LAST_WITH_IMMEDIATE': 0x09,
+    'RDMA_WRITE_ONLY': 0x0a,
+    'RDMA_WRITE_ONLY_WITH_IMMEDIATE': 0x0b,
+    'RDMA_READ_REQUEST': 0x0c,
+    'RDMA_READ_RESPONSE_FIRST': 0x0d,
+    'RDMA_READ_RESPONSE_MIDDLE': 0x0e,
+    'RDMA_READ_RESPONSE_LAST': 0x0f,
+    'RDMA_READ_RESPONSE_ONLY': 0x10,
+    'ACKNOWLEDGE': 0x11,
+    'ATOMIC_ACKNOWLEDGE': 0x12,
+    'COMPARE_SWAP': 0x13,
+    'FETCH_ADD': 0x14,
+    'RESYNC': 0x15,
+    'SEND_LAST_WITH_INVALIDATE': 0x16,
+    'SEND_ONLY_WITH_INVALIDATE': 0x17,
+}
+
+
+CNP_OPCODE = 0x81
+ICRC_LEN = 4
+UDP_HDR_LEN = 8
+IPV4_HDR_LEN = 20
+IP_PROTO_UDP = 17
+
+
+def opcode(transport, op):
+    # type: (str, str) -> Tuple[int, str]
+    return (_transports[transport] + _ops[op], '{}_{}'.format(transport, op))
+
+_op_names = {CNP_OPCODE: 'CNP'} # Opcode -> name, for packet summary
+for _transport in _transports:
+    for _op in _ops:
+        _op_code, _op_name = opcode(_transport, _op)
+        _op_names.setdefault(_op_code, _op_name)
+
+
+class Header:
+    __slots__ = ()
+    name = None
+    codec = None
+
+    def fields(self):
+        return {f: getattr(self, f) for f in self.__slots__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.fields() == other.fields()
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.name, ' '.join(f'{f}={v!r}' for f, v in self.fields().items()))
+
+    def __truediv__(self, other):
+        return RoCEPacket([self]) / other
+
+    def __len__(self):
+        return self.codec.size
+
+    @classmethod
+    def unpack_from(cls, buf, offset = 0):
+        return cls(*cls.codec.unpack_from(buf, offset))
+
+    def pack(self):
+        # Like scapy, a field of None is packed as its default value 0
+        return self.codec.pack(*[getattr(self, f) or 0 for f in self.__slots__])
+
+
+class BTH(Header):
+    __slots__ = ('opcode', 'solicited', 'migreq', 'padcount', 'version', 'pkey',
+        'fecn', 'becn', 'resv6', 'dqpn', 'ackreq', 'resv7', 'psn', 'icrc')
+    name = 'BTH'
+    codec = struct.Struct('!BBHII')
+
+    def __init__(self, opcode = 0, solicited = 0, migreq = 0, padcount = 0, version = 0, pkey = 0xffff,
+        fecn = 0, becn = 0, resv6 = 0, dqpn = 0, ackreq = 0, resv7 = 0, psn = 0, icrc = None):
+        self.opcode = opcode
+        self.solicited = solicited
+        self.migreq = migreq
+        self.padcount = padcount
+        self.version = version
+        self.pkey = pkey
+        self.fecn = fecn
+        self.becn = becn
+        self.resv6 = resv6
+        self.dqpn = dqpn
+        self.ackreq = ackreq
+        self.resv7 = resv7
+        self.psn = psn
+        self.icrc = icrc
+
+    @classmethod
+    def unpack_from(cls, buf, offset = 0):
+        opcode, flags, pkey, dqpn_word, psn_word = cls.codec.unpack_from(buf, offset)
+        return cls(
+            opcode = opcode,
+            solicited = flags >> 7,
+            migreq = (flags >> 6) & 0x1,
+            padcount = (flags >> 4) & 0x3,
+            version = flags & 0xf,
+            pkey = pkey,
+            fecn = dqpn_word >> 31,
+            becn = (dqpn_word >> 30) & 0x1,
+            resv6 = (dqpn_word >> 24) & 0x3f,
+            dqpn = dqpn_word & 0xffffff,
+            ackreq = psn_word >> 31,
+            resv7 = (psn_word >> 24) & 0x7f,
+            psn = psn_word & 0xffffff,
+        )
+
+    def pack(self):
+        return self.codec.pack(
+            self.opcode,
+            (self.solicited & 0x1) << 7 | (self.migreq & 0x1) << 6 | (self.padcount & 0x3) << 4 | (self.version & 0xf),
+            self.pkey,
+            (self.fecn & 0x1) << 31 | (self.becn & 0x1) << 30 | (self.resv6 & 0x3f) << 24 | (self.dqpn & 0xffffff),
+            (self.ackreq & 0x1) << 31 | (self.resv7 & 0x7f) << 24 | (self.psn & 0xffffff),
+        )
+
+
+AETH_CODES = {'ACK': 0, 'RNR': 1, 'RSVD': 2, 'NAK': 3}
+
+class AETH(Header):
+    __slots__ = ('rsvd', 'code', 'value', 'msn')
+    name = 'AETH'
+    codec = struct.Struct('!I')
+
+    def __init__(self, rsvd = 0, code = 'RSVD', value = 0, msn = 0):
+        self.rsvd = rsvd
+        self.code = AETH_CODES[code] if isinstance(code, str) else code
+        self.value = value
+        self.msn = msn
+
+    @classmethod
+    def unpack_from(cls, buf, offset = 0):
+        (word,) = cls.codec.unpack_from(buf, offset)
+        return cls(rsvd = word >> 31, code = (word >> 29) & 0x3, value = (word >> 24) & 0x1f, msn = word & 0xffffff)
+
+    def pack(self):
+        return self.codec.pack((self.rsvd & 0x1) << 31 | (self.code & 0x3) << 29 | (self.value & 0x1f) << 24 | (self.msn & 0xffffff))
+
+
+class RETH(Header):
+    __slots__ = ('va', 'rkey', 'dlen')
+    name = 'RETH'
+    codec = struct.Struct('!QII')
+
+    def __init__(self, va = 0, rkey = 0, dlen = 0):
+        self.va = va
+        self.rkey = rkey
+        self.dlen = dlen
+
+
+class AtomicETH(Header):
+    __slots__ = ('va', 'rkey', 'comp', 'swap')
+    name = 'AtomicETH'
+    codec = struct.Struct('!QIQQ')
+
+    def __init__(self, va = 0, rkey = 0, comp = 0, swap = 0):
+        self.va = va
+        self.rkey = rkey
+        self.comp = comp
+        self.swap = swap
+
+
+class AtomicAckETH(Header):
+    __slots__ = ('orig',)
+    name = 'AtomicAckETH'
+    codec = struct.Struct('!Q')
+
+    def __init__(self, orig = 0):
+        self.orig = orig
+
+
+class ImmDt(Header):
+    __slots__ = ('data',)
+    name = 'ImmDt'
+    codec = struct.Struct('!I')
+
+    def __init__(self, data = 0):
+        self.data = data
+
+
+class IETH(Header):
+    __slots__ = ('rkey',)
+    name = 'IETH'
+    codec = struct.Struct('!I')
+
+    def __init__(self, rkey = 0):
+        self.rkey = rkey
+
+
+class DETH(Header): # for UD only
+    __slots__ = ('qkey', 'rsvd', 'sqpn')
+    name = 'DETH'
+    codec = struct.Struct('!II')
+
+    def __init__(self, qkey = 0, rsvd = 0, sqpn = 0):
+        self.qkey = qkey
+        self.rsvd = rsvd
+        self.sqpn = sqpn
+
+    @classmethod
+    def unpack_from(cls, buf, offset = 0):
+        qkey, sqpn_word = cls.codec.unpack_from(buf, offset)
+        return cls(qkey = qkey, rsvd = sqpn_word >> 24, sqpn = sqpn_word & 0xffffff)
+
+    def pack(self):
+        return self.codec.pack(self.qkey, (self.rsvd & 0xff) << 24 | (self.sqpn & 0xffffff))
+
+
+class RETHImmDt(Header): # for RDMA_WRITE_ONLY_WITH_IMMEDIATE only
+    __slots__ = ('va', 'rkey', 'dlen', 'data')
+    name = 'RETHImmDt'
+    codec = struct.Struct('!QIII')
+
+    def __init__(self, va = 0, rkey = 0, dlen = 0, data = 0):
+        self.va = va
+        self.rkey = rkey
+        self.dlen = dlen
+        self.data = data
+
+
+# A payload gathered from several buffers, e.g. the SGEs of a WR, it is sent by
+# scatter/gather IO and covered by ICRC piece by piece, without being concatenated
+class Gather:
+    __slots__ = ('bufs', 'length')
+
+    def __init__(self, bufs):
+        self.bufs = bufs
+        self.length = sum([len(buf) for buf in bufs])
+
+    def __len__(self):
+        return self.length
+
+    def __bytes__(self):
+        return b''.join(self.bufs)
+
+
+class Raw(Header):
+    __slots__ = ('load',)
+    name = 'Raw'
+
+    def __init__(self, load = b''):
+        self.load = load
+
+    def __len__(self):
+        return len(self.load)
+
+    def pack(self):
+        return bytes(self.load)
+
+
+# The extended transport headers following BTH, same as the bind_layers() in roce.py
+_ext_hdrs = {}
+for _transport in ['RC', 'UC']:
+    for _op in ['SEND_LAST_WITH_IMMEDIATE', 'SEND_ONLY_WITH_IMMEDIATE', 'RDMA_WRITE_LAST_WITH_IMMEDIATE']:
+        _ext_hdrs[opcode(_transport, _op)[0]] = (ImmDt,)
+    for _op in ['RDMA_WRITE_FIRST', 'RDMA_WRITE_ONLY']:
+        _ext_hdrs[opcode(_transport, _op)[0]] = (RETH,)
+    # RDMA_WRITE_ONLY_WITH_IMMEDIATE use RETHImmDt, instead of RETH/ImmDt
+    _ext_hdrs[opcode(_transport, 'RDMA_WRITE_ONLY_WITH_IMMEDIATE')[0]] = (RETHImmDt,)
+_ext_hdrs[opcode('RC', 'RDMA_READ_REQUEST')[0]] = (RETH,)
+_ext_hdrs[opcode('RC', 'RDMA_READ_RESPONSE_FIRST')[0]] = (AETH,)
+_ext_hdrs[opcode('RC', 'RDMA_READ_RESPONSE_LAST')[0]] = (AETH,)
+_ext_hdrs[opcode('RC', 'RDMA_READ_RESPONSE_ONLY')[0]] = (AETH,)
+_ext_hdrs[opcode('RC', 'ACKNOWLEDGE')[0]] = (AETH,)
+_ext_hdrs[opcode('RC', 'ATOMIC_ACKNOWLEDGE')[0]] = (AETH, AtomicAckETH)
+_ext_hdrs[opcode('RC', 'COMPARE_SWAP')[0]] = (AtomicETH,)
+_ext_hdrs[opcode('RC', 'FETCH_ADD')[0]] = (AtomicETH,)
+_ext_hdrs[opcode('RC', 'SEND_LAST_WITH_INVALIDATE')[0]] = (IETH,)
+_ext_hdrs[opcode('RC', 'SEND_ONLY_WITH_INVALIDATE')[0]] = (IETH,)
+# UD only has single packet send, DETH is followed by ImmDt if any
+_ext_hdrs[opcode('UD', 'SEND_ONLY')[0]] = (DETH,)
+_ext_hdrs[opcode('UD', 'SEND_ONLY_WITH_IMMEDIATE')[0]] = (DETH, ImmDt)
+
+
+class RoCEPacket:
+    __slots__ = ('layers',)
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __truediv__(self, other):
+        if isinstance(other, RoCEPacket):
+            return RoCEPacket(self.layers + other.layers)
+        return RoCEPacket(self.layers + [other])
+
+    def __getitem__(self, layer_cls):
+        for layer in self.layers:
+            if type(layer) is layer_cls:
+                return layer
+        raise IndexError(f'Layer [{layer_cls.name}] not found')
+
+    def __contains__(self, layer_cls):
+        for layer in self.layers:
+            if type(layer) is layer_cls:
+                return True
+        return False
+
+    def haslayer(self, layer_cls):
+        return layer_cls in self
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.layers) + ICRC_LEN
+
+    def __repr__(self):
+        return ' / '.join(repr(layer) for layer in self.layers)
+
+    def encode(self):
+        # The encoded packet has no ICRC, which depends on the IP and UDP headers
+        return b''.join([layer.pack() for layer in self.layers])
+
+    def encode_parts(self):
+        # Return the encoded headers and the payload as is, to send them without
+        # copying the payload, which is usually a memoryview of an MR
+        if type(self.layers[-1]) is Raw:
+            return (b''.join([layer.pack() for layer in self.layers[:-1]]), self.layers[-1].load)
+        return (self.encode(), b'')
+
+    def to_scapy(self):
+        # Build the scapy view of the packet, only for debugging
+        import roce
+        from scapy.packet import Raw as ScapyRaw
+
+        scapy_pkt = None
+        for layer in self.layers:
+            if type(layer) is Raw:
+                scapy_layer = ScapyRaw(load = bytes(layer.load))
+            else:
+                scapy_layer = getattr(roce, layer.name)(**layer.fields())
+            scapy_pkt = scapy_layer if scapy_pkt is None else scapy_pkt/scapy_layer
+        return scapy_pkt
+
+    def show(self, dump = False):
+        try:
+            return self.to_scapy().show(dump = dump)
+        except ImportError: # scapy is optional
+            if dump:
+                return repr(self)
+            print(repr(self))
+
+    def summary(self):
+        # One line of opcode, PSN, QPN and length
+        bth = self.layers[0]
+        return '{} PSN={} QPN={} len={}'.format(_op_names.get(bth.opcode, hex(bth.opcode)), bth.psn, bth.dqpn, len(self))
+
+
+class PktTrace:
+    # Defer rendering a packet until the log record is emitted, e.g.
+    # logging.debug('received: %s', PktTrace(pkt)) costs nothing if DEBUG is disabled.
+    # Use PktTrace.configure() to log one line summary instead of the full dump,
+    # or to dump only one in every N traced packets in full.
+    __slots__ = ('pkt',)
+
+    summary_only = False
+    full_dump_interval = 1
+    traced_num = 0
+
+    def __init__(self, pkt):
+        self.pkt = pkt
+
+    def __str__(self):
+        if not PktTrace.summary_only:
+            PktTrace.traced_num += 1
+            if PktTrace.traced_num >= PktTrace.full_dump_interval:
+                PktTrace.traced_num = 0
+                return self.pkt.show(dump = True)
+        return self.pkt.summary()
+
+    @classmethod
+    def configure(cls, summary_only = None, full_dump_interval = None):
+        if summary_only is not None:
+            cls.summary_only = summary_only
+        if full_dump_interval is not None:
+            assert full_dump_interval > 0, 'full_dump_interval should be positive'
+            cls.full_dump_interval = full_dump_interval
+            cls.traced_num = 0
+
+
+def decode_pkt(roce_bytes):
+    # Decode BTH/ETH/payload/ICRC from the UDP payload
+    bth = BTH.unpack_from(roce_bytes)
+    layers = [bth]
+    offset = BTH.codec.size
+    for hdr_cls in _ext_hdrs.get(bth.opcode, ()):
+        layers.append(hdr_cls.unpack_from(roce_bytes, offset))
+        offset += hdr_cls.codec.size
+    payload_end = len(roce_bytes) - ICRC_LEN
+    if payload_end > offset:
+        layers.append(Raw(load = roce_bytes[offset:payload_end]))
+    (bth.icrc,) = struct.unpack_from('!I', roce_bytes, payload_end)
+    return RoCEPacket(layers)
+
+
+# ICRC masked pseudo-header: LRH / IP / UDP, variant fields are set to all 1s
+_lrh_mask = b'\xff' * 8
+_ipv4_pseudo_hdr = struct.Struct('!BBHHHBBH4s4s') # version/IHL, TOS, len, id, flags/frag, TTL, proto, checksum, src, dst
+_ipv6_pseudo_hdr = struct.Struct('!IHBB16s16s') # version/TC/flow label, payload len, next header, hop limit, src, dst
+_udp_pseudo_hdr = struct.Struct('!HHHH') # sport, dport, len, checksum
+_bth_resv8a_mask = b'\xff' # FECN, BECN and resv6 of BTH
+
+GRH_LEN = 40
+GRH_HOP_LIMIT = 64 # The received TTL/hop limit is unknown to UDP socket
+
+def encode_grh(src_ip, dst_ip, roce_len, ip_flags = 0):
+    # The GRH of a received RoCEv2 packet is its IP header, which UD places in front of
+    # the receive buffer. An IPv4 header takes the last 20 bytes of the 40 bytes GRH.
+    # src_ip and dst_ip are packed, 4 bytes for IPv4 and 16 bytes for IPv6
+    udp_len = UDP_HDR_LEN + roce_len
+    if len(src_ip) == 16:
+        return _ipv6_pseudo_hdr.pack(0x60000000, udp_len, IP_PROTO_UDP, GRH_HOP_LIMIT, src_ip, dst_ip)
+    ip_hdr = _ipv4_pseudo_hdr.pack(0x45, 0, IPV4_HDR_LEN + udp_len, 0, ip_flags << 13,
+        GRH_HOP_LIMIT, IP_PROTO_UDP, 0, src_ip, dst_ip)
+    checksum = sum(struct.unpack('!10H', ip_hdr))
+    checksum = (checksum & 0xffff) + (checksum >> 16)
+    checksum = (checksum & 0xffff) + (checksum >> 16)
+    return bytes(GRH_LEN - IPV4_HDR_LEN) + ip_hdr[:10] + struct.pack('!H', ~checksum & 0xffff) + ip_hdr[12:]
+
+
+class IcrcFlow:
+    # The ICRC of one (src, dst, QP) flow, only the IP/UDP length fields of
+    # its pseudo-header vary per packet, so the CRC of the pseudo-header is
+    # cached per UDP length, and BTH and payload are folded into it.
+    __slots__ = ('src_ip', 'dst_ip', 'sport', 'dport', 'ip_id', 'ip_flags', 'prefix_crc')
+
+    def __init__(self, src_ip, dst_ip, sport, dport, ip_id = 0, ip_flags = 0):
+        # src_ip and dst_ip are packed, 4 bytes for IPv4 and 16 bytes for IPv6
+        assert len(src_ip) == len(dst_ip) and len(src_ip) in (4, 16), 'source and destination IP should be both IPv4 or IPv6'
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.sport = sport
+        self.dport = dport
+        self.ip_id = ip_id
+        self.ip_flags = ip_flags
+        self.prefix_crc = {} # UDP length -> CRC of pseudo LRH/IP/UDP
+
+    def ipv6(self):
+        return len(self.src_ip) == 16
+
+    def pseudo_hdr(self, udp_len):
+        if self.ipv6():
+            ip_hdr = _ipv6_pseudo_hdr.pack(0x6fffffff, udp_len, IP_PROTO_UDP, 0xff, self.src_ip, self.dst_ip)
+        else:
+            ip_hdr = _ipv4_pseudo_hdr.pack(0x45, 0xff, IPV4_HDR_LEN + udp_len, self.ip_id, self.ip_flags << 13,
+                0xff, IP_PROTO_UDP, 0xffff, self.src_ip, self.dst_ip)
+        return _lrh_mask + ip_hdr + _udp_pseudo_hdr.pack(self.sport, self.dport, udp_len, 0xffff)
+
+    def compute(self, roce_bytes, payload = b''):
+        # roce_bytes is from BTH to payload, ICRC not included,
+        # or the headers from BTH if the payload is given separately
+        udp_len = UDP_HDR_LEN + len(roce_bytes) + len(payload) + ICRC_LEN
+        crc = self.prefix_crc.get(udp_len)
+        if crc is None:
+            crc = crc32(self.pseudo_hdr(udp_len))
+            self.prefix_crc[udp_len] = crc
+        roce_view = memoryview(roce_bytes)
+        crc = crc32(roce_view[:4], crc)
+        crc = crc32(_bth_resv8a_mask, crc)
+        crc = crc32(roce_view[5:], crc)
+        if type(payload) is Gather:
+            for buf in payload.bufs:
+                crc = crc32(buf, crc)
+            return crc
+        return crc32(payload, crc) if payload else crc
+
+    def icrc(self, roce_bytes, payload = b''):
+        # ICRC is transmitted in little endian
+        return struct.pack('<I', self.compute(roce_bytes, payload))
+
+
+class IcrcEngine:
+    def __init__(self):
+        self.flows = {}
+
+    def flow(self, src_ip, dst_ip, sport, dport, ip_id = 0, ip_flags = 0):
+        flow_key = (src_ip, dst_ip, sport, dport, ip_id, ip_flags)
+        icrc_flow = self.flows.get(flow_key)
+        if icrc_flow is None:
+            icrc_flow = IcrcFlow(src_ip, dst_ip, sport, dport, ip_id, ip_flags)
+            self.flows[flow_key] = icrc_flow
+        return icrc_flow
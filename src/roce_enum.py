@@ -1,5 +1,5 @@
 from enum import IntEnum, IntFlag
-from roce import opcode
+from roce_codec import opcode
 
 DEFAULT_FLAG = 0
 
@@ -13,6 +13,11 @@ class QPS(IntEnum):
     ERR = 6
     UNKNOWN = 7
 
+class QPT(IntEnum):
+    RC = 2
+    UC = 3
+    UD = 4
+
 class PMTU(IntEnum):
     MTU_256 = 256
     MTU_512 = 512
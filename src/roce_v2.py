@@ -1,30 +1,80 @@
+import array
+import asyncio
+import bisect
+import collections
 import copy
+import errno
 import logging
+import math
+import mmap
+import os
 import random
+import select
 import socket
-import struct
 import sys
+import time
 
 # from logging import debug, info, warning, error, critical
 from roce_enum import *
-from scapy.all import *
-from roce import *
+from roce_codec import AETH, AtomicAckETH, AtomicETH, BTH, DETH, IETH, ImmDt, RETH, RETHImmDt, Raw, Gather, GRH_LEN, IcrcEngine, PktTrace, decode_pkt, encode_grh
 
 ATOMIC_BYTE_SIZE = 8
-UDP_BUF_SIZE = 1024
+MAX_ROCE_HDR_SIZE = 64 # BTH, extended transport headers and ICRC
+UDP_BUF_SIZE = PMTU.MTU_4096 + MAX_ROCE_HDR_SIZE # Large enough for any PMTU
+RECV_BATCH_SIZE = 64
+SEQ_RING_INIT_SIZE = 64 # Must be power of 2
+TIMER_TICK_NS = 1_000_000 # 1ms
+TIMER_WHEEL_SLOT_NUM = 64 # Must be power of 2
+TIMER_WHEEL_LEVEL_NUM = 4 # 64^4 ticks, about 4.6 hours, longer than the max ACK timeout
 
 CREDIT_CNT_INVALID = 31
+# AETH credit count -> number of credits, the log-scale encoding of available receive WQEs
+AETH_CREDIT_TABLE = [0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64, 96, 128, 192, 256, 384, 512, 768,
+    1024, 1536, 2048, 3072, 4096, 6144, 8192, 12288, 16384, 24576, 32768]
+ARRAY_CQ_NONE = 2**64 - 1 # Stands for None of wr_id and imm_data_or_inv_rkey in ArrayCQ
+DEFAULT_ACK_COALESCE_PKTS = 1 # Respond ACK to each request asking for it
+DEFAULT_ACK_COALESCE_US = 1000 # Should be well below the ACK timeout of the requester
+DEFAULT_ACKREQ_FREQ = 1 # Ask for ACK in the last packet of each signaled WR
+DEFAULT_CQ_SIZE = 4096
+DEFAULT_MAX_INLINE_DATA = 256
+DEFAULT_MAX_SGE = 32
+DEFAULT_MAX_SRQ_WR = 4096
 DEFAULT_PKEY = 0xFFFF
+DEFAULT_QKEY = 0
 DEFAULT_RNR_WAIT_TIME = 4
 DEFAULT_TIMEOUT = 4
 EMPTY_SEND_FLAG = 0
 EMPTY_WC_FLAG = 0
 ROCE_PORT = 4791
 
+IP_FLAG_DF = 2 # The DF bit in IPv4 3-bit flags
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10) # Linux only socket option
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+
 MAX_SSN = 2**24
 MAX_MSN = 2**24
 MAX_PSN = 2**24
 
+# MR backing store
+MR_HEAP_BACKED = 0 # bytearray in Python heap
+MR_MMAP_BACKED = 1 # Anonymous mmap, pages are zero-filled on demand
+MR_FILE_BACKED = 2 # Shared mmap of a file, the file is created or extended to MR length
+MR_SPARSE_BACKED = 3 # Page table of bytearray, pages are allocated on first write
+
+SPARSE_PAGE_SIZE = 4096
+SPARSE_ZERO_PAGE = bytes(SPARSE_PAGE_SIZE) # Shared by all untouched pages of sparse MR
+
+# CQ notification request
+CQ_NOTIFY_NONE = 0
+CQ_NOTIFY_NEXT_COMP = 1 # Notify on next completion
+CQ_NOTIFY_SOLICITED = 2 # Notify on next solicited or unsuccessful completion
+
+OPCODE_MASK = 0x1F # The operation part of BTH opcode, handlers use RC opcodes for all transports
+TRANSPORT_RC = 0x00
+TRANSPORT_UC = 0x20
+TRANSPORT_UD = 0x60
+QKEY_USE_QP = 0x80000000 # UD send WR Q_Key with the high-order bit set uses the Q_Key of QP
+
 NO_RETRY = 0
 RNR_RETRY = 1
 OTHER_RETRY = 2
@@ -55,8 +105,10 @@ class Util:
         elif pre_op == RC.RDMA_WRITE_FIRST or pre_op == RC.RDMA_WRITE_MIDDLE:
             assert cur_op == RC.RDMA_WRITE_MIDDLE or RC.write_last(cur_op)
         elif pre_op == RC.RDMA_READ_RESPONSE_FIRST or pre_op == RC.RDMA_READ_RESPONSE_MIDDLE:
-            # Allow out of order ACK in between read response, or NAK to early terminate read response
-            assert cur_op == RC.RDMA_READ_RESPONSE_MIDDLE or cur_op == RC.RDMA_READ_RESPONSE_LAST or cur_op == RC.ACKNOWLEDGE
+            # Allow out of order ACK in between read response, or NAK to early terminate read response,
+            # or the responses to a retried read request
+            assert (cur_op == RC.RDMA_READ_RESPONSE_MIDDLE or cur_op == RC.RDMA_READ_RESPONSE_LAST or cur_op == RC.ACKNOWLEDGE
+                    or cur_op == RC.RDMA_READ_RESPONSE_FIRST or cur_op == RC.RDMA_READ_RESPONSE_ONLY)
         elif (RC.last_req_pkt(pre_op) or RC.only_req_pkt(pre_op) or RC.atomic(pre_op)
                 or pre_op == RC.RDMA_READ_RESPONSE_LAST or pre_op == RC.RDMA_READ_RESPONSE_ONLY
                 or pre_op == RC.ATOMIC_ACKNOWLEDGE or pre_op == RC.ACKNOWLEDGE):
@@ -206,7 +258,7 @@ class Util:
         elif timeout_val == 1:
             timeout_ns = 8192
         elif timeout_val == 2:
-            timeout_ns == 16_384
+            timeout_ns = 16_384
         elif timeout_val == 3:
             timeout_ns = 32_768
         elif timeout_val == 4:
@@ -269,15 +321,41 @@ class Util:
             raise Exception(f'unsupported timeout value={timeout_ns}')
         return timeout_ns
 
+    # A WR takes a single SG or a list of SG
+    def to_sge_list(sgl):
+        if sgl is None:
+            return []
+        return sgl if isinstance(sgl, list) else [sgl]
+
 class MR:
-    def __init__(self, va, length, access_flags, lkey, rkey):
+    def __init__(self, va, length, access_flags, lkey, rkey, backing = MR_HEAP_BACKED, backing_file = None):
         #assert ACCESS_FLAGS.ZERO_BASED & access_flags, 'only zero-based address supported'
         self.va = va
         self.local_key = lkey
         self.remote_key = rkey
         self.length = length
         self.access_flags = access_flags
-        self.byte_data = bytearray(struct.pack(f'<{self.len()}s', b'\0')) # '\0' has no endien issue
+        self.backing = backing
+        self.backing_fd = None
+        self.page_dict = None
+        self.byte_data = None
+        self.byte_view = None
+        if backing == MR_SPARSE_BACKED:
+            self.page_dict = {} # Page index to bytearray, untouched pages are not allocated
+        elif backing == MR_HEAP_BACKED or length == 0: # Cannot mmap zero length
+            self.byte_data = bytearray(length)
+        elif backing == MR_MMAP_BACKED:
+            self.byte_data = mmap.mmap(-1, length)
+        elif backing == MR_FILE_BACKED:
+            assert backing_file is not None, 'file-backed MR requires backing_file'
+            self.backing_fd = os.open(backing_file, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self.backing_fd).st_size < length:
+                os.ftruncate(self.backing_fd, length) # Extended part is a hole, no disk space used
+            self.byte_data = mmap.mmap(self.backing_fd, length)
+        else:
+            raise Exception(f'unsupported MR backing={backing}')
+        if self.byte_data is not None:
+            self.byte_view = memoryview(self.byte_data) # The MR size never changes, so it is safe to export
         # self.pos = 0
 
     def addr(self):
@@ -296,8 +374,11 @@ class MR:
         return self.access_flags
 
     def write(self, byte_data, addr = 0):
-        addr_in_mr = addr if ACCESS_FLAGS.ZERO_BASED & self.flags() else addr - self.addr()
-        assert addr_in_mr >= 0 and addr_in_mr + len(byte_data) <= self.len(), 'write address and size not within MR'
+        addr_in_mr = addr if ACCESS_FLAGS.ZERO_BASED & self.access_flags else addr - self.va
+        assert addr_in_mr >= 0 and addr_in_mr + len(byte_data) <= self.length, 'write address and size not within MR'
+        if self.page_dict is not None:
+            self.sparse_write(byte_data, addr_in_mr)
+            return
         self.byte_data[addr_in_mr : (addr_in_mr + len(byte_data))] = byte_data
         # self.pos = addr_in_mr + len(byte_data)
 
@@ -306,21 +387,86 @@ class MR:
     #     self.byte_data[self.pos : (self.pos + len(byte_data))] = byte_data
     #     self.pos += len(byte_data)
 
+    # Return a memoryview of the MR without copy, slice it to get each packet payload
     def read(self, addr, size):
-        addr_in_mr = addr if ACCESS_FLAGS.ZERO_BASED & self.flags() else addr - self.addr()
-        assert addr_in_mr >= 0 and addr_in_mr + size <= self.len(), 'read address and size not within MR'
-        return self.byte_data[addr_in_mr: (addr_in_mr + size)]
+        addr_in_mr = addr if ACCESS_FLAGS.ZERO_BASED & self.access_flags else addr - self.va
+        assert addr_in_mr >= 0 and addr_in_mr + size <= self.length, 'read address and size not within MR'
+        if self.page_dict is not None:
+            return self.sparse_read(addr_in_mr, size)
+        return self.byte_view[addr_in_mr: (addr_in_mr + size)]
+
+    # Return a copy of the MR data, for callers outside SQ/RQ that keep the data
+    def read_bytes(self, addr, size):
+        return bytes(self.read(addr = addr, size = size))
+
+    def sparse_write(self, byte_data, addr_in_mr):
+        data_view = memoryview(byte_data).cast('B')
+        data_pos = 0
+        while data_pos < len(data_view):
+            page_idx, page_offset = divmod(addr_in_mr + data_pos, SPARSE_PAGE_SIZE)
+            write_size = min(SPARSE_PAGE_SIZE - page_offset, len(data_view) - data_pos)
+            page = self.page_dict.get(page_idx)
+            if page is None:
+                page = bytearray(SPARSE_PAGE_SIZE)
+                self.page_dict[page_idx] = page
+            page[page_offset : (page_offset + write_size)] = data_view[data_pos : (data_pos + write_size)]
+            data_pos += write_size
+
+    # Return a view without copy if the read is within one page, otherwise the pages are joined into bytes
+    def sparse_read(self, addr_in_mr, size):
+        page_idx, page_offset = divmod(addr_in_mr, SPARSE_PAGE_SIZE)
+        if page_offset + size <= SPARSE_PAGE_SIZE:
+            page = self.page_dict.get(page_idx, SPARSE_ZERO_PAGE)
+            return memoryview(page)[page_offset : (page_offset + size)]
+
+        part_list = []
+        data_pos = 0
+        while data_pos < size:
+            page_idx, page_offset = divmod(addr_in_mr + data_pos, SPARSE_PAGE_SIZE)
+            read_size = min(SPARSE_PAGE_SIZE - page_offset, size - data_pos)
+            page = self.page_dict.get(page_idx, SPARSE_ZERO_PAGE)
+            part_list.append(memoryview(page)[page_offset : (page_offset + read_size)])
+            data_pos += read_size
+        return b''.join(part_list)
+
+    # Number of bytes actually allocated for the MR data
+    def resident_size(self):
+        if self.page_dict is not None:
+            return len(self.page_dict) * SPARSE_PAGE_SIZE
+        return self.len()
+
+    def close(self):
+        if self.page_dict is not None:
+            self.page_dict.clear()
+        if isinstance(self.byte_data, mmap.mmap):
+            try:
+                self.byte_view.release()
+                self.byte_data.close() # Flush file-backed MR
+            except BufferError: # Views of MR are still in use, unmap when they are released
+                logging.warning(f'MR lkey={self.lkey()} is still in use, it will be unmapped later')
+        if self.backing_fd is not None:
+            os.close(self.backing_fd) # The mapping stays valid after the file is closed
+            self.backing_fd = None
 
 class PD:
     def __init__(self, pdn):
         self.pdn = pdn
         self.qp_dict = {}
+        self.srq_dict = {}
         #self.cq_dict = {}
         self.mr_dict = {}
         self.next_key = 1
     
-    def reg_mr(self, va, length, access_flags):
-        mr = MR(va = va, length = length, access_flags = access_flags, lkey = self.next_key, rkey = self.next_key)
+    def reg_mr(self, va, length, access_flags, backing = MR_HEAP_BACKED, backing_file = None):
+        mr = MR(
+            va = va,
+            length = length,
+            access_flags = access_flags,
+            lkey = self.next_key,
+            rkey = self.next_key,
+            backing = backing,
+            backing_file = backing_file,
+        )
         self.mr_dict[mr.lkey()] = mr
         self.mr_dict[mr.rkey()] = mr
         self.next_key += 1
@@ -330,6 +476,7 @@ class PD:
         del self.mr_dict[mr.rkey()]
         if mr.lkey() in self.mr_dict:
             del self.mr_dict[mr.lkey()]
+        mr.close()
 
     def has_mr(self, lrkey):
         return lrkey in self.mr_dict
@@ -340,6 +487,9 @@ class PD:
     def add_qp(self, qp):
         self.qp_dict[qp.qpn()] = qp
 
+    def add_srq(self, srq):
+        self.srq_dict[srq.srqn()] = srq
+
     def validate_mr(self, rc_op, lrkey, addr, data_size):
         assert self.has_mr(lrkey), 'invalid lkey or rkey'
         mr = self.get_mr(lrkey)
@@ -354,7 +504,29 @@ class PD:
 
         return True
 
+    # Write data to the SGL from sgl_offset, across SGEs if needed
+    def scatter(self, rc_op, sgl, sgl_offset, byte_data):
+        data_view = memoryview(byte_data)
+        data_pos = 0
+        sge_begin = 0
+        for sge in sgl:
+            if data_pos == len(data_view):
+                break
+            sge_end = sge_begin + sge.length
+            if sgl_offset + data_pos < sge_end:
+                write_addr = sge.pos_in_mr + (sgl_offset + data_pos - sge_begin)
+                write_size = min(sge_end - sgl_offset - data_pos, len(data_view) - data_pos)
+                # TODO: handle local protection error
+                assert self.validate_mr(rc_op, sge.local_key, write_addr, write_size), 'SGE local access error'
+                self.get_mr(sge.local_key).write(data_view[data_pos : (data_pos + write_size)], addr = write_addr)
+                data_pos += write_size
+            sge_begin = sge_end
+        # TODO: handle length error
+        assert data_pos == len(data_view), 'no enough SGL buffer for the data'
+
 class CQE:
+    __slots__ = ('wr_id', 'cqe_status', 'opcode', 'length', 'qpn', 'src_qp', 'wc_flags', 'imm_data_inv_rkey')
+
     def __init__(self, wr_id, status, opcode, length, qpn, src_qp, wc_flags, imm_data_or_inv_rkey = None):
         self.wr_id = wr_id
         self.cqe_status = status
@@ -386,20 +558,200 @@ class CQE:
     def imm_data_or_inv_rkey(self):
         return self.imm_data_inv_rkey
 
+# Completion channel, the readable end of a socket pair becomes readable when an armed CQ gets a completion,
+# so it can be waited by select/poll or by the asyncio event loop
+class CompChannel:
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+        self.event_cq_list = collections.deque() # CQs which have notified, one byte in the socket pair per CQ
+
+    def fileno(self):
+        return self.rsock.fileno()
+
+    def notify(self, cq):
+        self.event_cq_list.append(cq)
+        try:
+            self.wsock.send(b'\0')
+        except BlockingIOError: # The socket pair is full, but it is readable anyway
+            logging.warning(f'completion channel has too many pending events={len(self.event_cq_list)}')
+
+    def consume_event(self):
+        try:
+            self.rsock.recv(1)
+        except BlockingIOError:
+            pass
+        return self.event_cq_list.popleft()
+
+    # Block until a CQ event arrives, return the CQ or None if timeout
+    def get_cq_event(self, timeout = None):
+        if not self.event_cq_list:
+            readable, _, _ = select.select([self.rsock], [], [], timeout)
+            if not readable:
+                return None
+        return self.consume_event()
+
+    async def wait_cq_event(self):
+        if not self.event_cq_list:
+            await asyncio.get_running_loop().sock_recv(self.rsock, 1)
+            return self.event_cq_list.popleft()
+        return self.consume_event()
+
+    def close(self):
+        self.rsock.close()
+        self.wsock.close()
+
 class CQ:
-    def __init__(self, cqn):
+    def __init__(self, cqn, cq_size = DEFAULT_CQ_SIZE, channel = None, timer_wheel = None):
+        assert cq_size > 0, 'CQ size should be positive'
         self.cqn = cqn
-        self.cq = []
+        self.cq_size = cq_size
+        self.cq = collections.deque()
+        self.overflowed = False
+        self.channel = channel
+        self.notify_flag = CQ_NOTIFY_NONE
+        # CQ moderation, delay the event until cq_count completions or cq_period_us since the first one
+        self.timer_wheel = timer_wheel
+        self.cq_count = 1
+        self.cq_period_us = 0
+        self.moderation_comp_num = 0 # Completions in current moderation window, 0 means no window
+        self.moderation_timer = None
+        self.event_num = 0
+        self.suppressed_event_num = 0 # Completions coalesced into an event fired by an earlier completion
 
     def pop(self):
-        return self.cq.pop(0)
-
-    def push(self, cqe):
+        # TODO: handle CQ overflow, it should generate CQ_ERR async event
+        assert not self.overflowed, f'CQ cqn={self.cqn} overflowed'
+        return self.cq.popleft()
+
+    def push(self, cqe, solicited = False):
+        if len(self.cq) >= self.cq_size:
+            # Drop the CQE like hardware does, the CQ is unusable after overflow
+            logging.error(f'CQ cqn={self.cqn} overflowed, cq_size={self.cq_size}')
+            self.overflowed = True
+            return
         self.cq.append(cqe)
+        if self.notify_flag != CQ_NOTIFY_NONE:
+            self.check_notify(cqe.cqe_status, solicited)
+
+    def check_notify(self, cqe_status, solicited):
+        if self.moderation_comp_num > 0: # Any completion counts once the moderation window is open
+            self.moderation_comp_num += 1
+            self.suppressed_event_num += 1
+            if self.moderation_comp_num >= self.cq_count:
+                self.fire_event()
+        elif self.notify_flag == CQ_NOTIFY_NEXT_COMP or solicited or cqe_status != WC_STATUS.SUCCESS:
+            self.moderation_comp_num = 1
+            if self.cq_count <= 1:
+                self.fire_event()
+            elif self.cq_period_us > 0:
+                self.moderation_timer = self.timer_wheel.schedule(self.cq_period_us * 1000, self.on_moderation_timer)
+
+    def on_moderation_timer(self):
+        self.moderation_timer = None
+        self.fire_event()
+
+    def fire_event(self):
+        if self.moderation_timer is not None:
+            self.timer_wheel.cancel(self.moderation_timer)
+            self.moderation_timer = None
+        self.moderation_comp_num = 0
+        self.notify_flag = CQ_NOTIFY_NONE # Notification is one shot, it must be requested again
+        self.event_num += 1
+        self.channel.notify(self)
+
+    # Like ibv_modify_cq, cq_count as 1 or cq_period_us as 0 disables the corresponding moderation,
+    # cq_period_us is rounded up to the timer wheel tick
+    def modify_moderation(self, cq_count, cq_period_us):
+        assert cq_count > 0, 'CQ moderation count should be positive'
+        assert cq_period_us == 0 or self.timer_wheel is not None, 'CQ moderation period requires timer wheel'
+        self.cq_count = cq_count
+        self.cq_period_us = cq_period_us
+
+    # Request a notification on the completion channel for the next completion
+    def req_notify(self, solicited_only = False):
+        assert self.channel is not None, 'CQ has no completion channel'
+        self.notify_flag = CQ_NOTIFY_SOLICITED if solicited_only else CQ_NOTIFY_NEXT_COMP
+
+    # Return at most max_entries CQEs in completion order
+    def poll(self, max_entries):
+        assert not self.overflowed, f'CQ cqn={self.cqn} overflowed'
+        cqe_num = min(max_entries, len(self.cq))
+        popleft = self.cq.popleft
+        return [popleft() for _ in range(cqe_num)]
 
     def empty(self):
         return not bool(self.cq)
 
+    def size(self):
+        return self.cq_size
+
+# CQ stores completions in preallocated array columns instead of CQE objects,
+# CQE objects are only created when polled
+class ArrayCQ(CQ):
+    def __init__(self, cqn, cq_size = DEFAULT_CQ_SIZE, channel = None, timer_wheel = None):
+        CQ.__init__(self, cqn, cq_size, channel, timer_wheel)
+        self.cq = None
+        self.head = 0 # Index of the oldest CQE
+        self.cqe_num = 0
+        self.wr_id_col = array.array('Q', [0]) * cq_size
+        self.status_col = array.array('B', [0]) * cq_size
+        self.opcode_col = array.array('B', [0]) * cq_size
+        self.length_col = array.array('Q', [0]) * cq_size
+        self.qpn_col = array.array('L', [0]) * cq_size
+        self.src_qp_col = array.array('L', [0]) * cq_size
+        self.wc_flags_col = array.array('H', [0]) * cq_size
+        self.imm_data_inv_rkey_col = array.array('Q', [0]) * cq_size
+
+    def push(self, cqe, solicited = False):
+        if self.cqe_num >= self.cq_size:
+            # Drop the CQE like hardware does, the CQ is unusable after overflow
+            logging.error(f'CQ cqn={self.cqn} overflowed, cq_size={self.cq_size}')
+            self.overflowed = True
+            return
+        idx = (self.head + self.cqe_num) % self.cq_size
+        self.wr_id_col[idx] = ARRAY_CQ_NONE if cqe.wr_id is None else cqe.wr_id
+        self.status_col[idx] = cqe.cqe_status
+        self.opcode_col[idx] = cqe.opcode
+        self.length_col[idx] = cqe.length
+        self.qpn_col[idx] = cqe.qpn
+        self.src_qp_col[idx] = cqe.src_qp
+        self.wc_flags_col[idx] = cqe.wc_flags
+        self.imm_data_inv_rkey_col[idx] = ARRAY_CQ_NONE if cqe.imm_data_inv_rkey is None else cqe.imm_data_inv_rkey
+        self.cqe_num += 1
+        if self.notify_flag != CQ_NOTIFY_NONE:
+            self.check_notify(cqe.cqe_status, solicited)
+
+    def pop(self):
+        # TODO: handle CQ overflow, it should generate CQ_ERR async event
+        assert not self.overflowed, f'CQ cqn={self.cqn} overflowed'
+        assert self.cqe_num > 0, 'pop from empty CQ'
+        idx = self.head
+        self.head = (idx + 1) % self.cq_size
+        self.cqe_num -= 1
+        wr_id = self.wr_id_col[idx]
+        imm_data_or_inv_rkey = self.imm_data_inv_rkey_col[idx]
+        return CQE(
+            wr_id = None if wr_id == ARRAY_CQ_NONE else wr_id,
+            status = WC_STATUS(self.status_col[idx]),
+            opcode = WC_OPCODE(self.opcode_col[idx]),
+            length = self.length_col[idx],
+            qpn = self.qpn_col[idx],
+            src_qp = self.src_qp_col[idx],
+            wc_flags = self.wc_flags_col[idx],
+            imm_data_or_inv_rkey = None if imm_data_or_inv_rkey == ARRAY_CQ_NONE else imm_data_or_inv_rkey,
+        )
+
+    # Return at most max_entries CQEs in completion order
+    def poll(self, max_entries):
+        assert not self.overflowed, f'CQ cqn={self.cqn} overflowed'
+        cqe_num = min(max_entries, self.cqe_num)
+        return [self.pop() for _ in range(cqe_num)]
+
+    def empty(self):
+        return self.cqe_num == 0
+
 # class SGE:
 #     def __init__(self, addr, length, lkey, data = b''):
 #         self.addr = addr
@@ -440,6 +792,8 @@ class CQ:
 #         return self.length
 
 class SG:
+    __slots__ = ('pos_in_mr', 'length', 'local_key')
+
     def __init__(self, pos_in_mr, length, lkey):
         self.pos_in_mr = pos_in_mr
         self.length = length
@@ -455,6 +809,9 @@ class SG:
         return self.local_key
 
 class SendWR:
+    __slots__ = ('opcode', 'send_flags', 'sgl', 'sgl_len', 'inline_data', 'wr_id', 'rmt_va', 'remote_key', 'compare_add_data', 'swap_data', 'imm_data_inv_rkey',
+        'ah', 'remote_qpn', 'remote_qkey')
+
     def __init__(self, opcode, sgl,
         wr_id = None,
         send_flags = EMPTY_SEND_FLAG,
@@ -463,35 +820,45 @@ class SendWR:
         compare_add = None,
         swap = None,
         imm_data_or_inv_rkey = None,
+        ah = None,
+        remote_qpn = None,
+        remote_qkey = None,
     ):
         self.opcode = opcode
         self.send_flags = send_flags
-        self.sgl = sgl
+        self.sgl = Util.to_sge_list(sgl)
+        self.sgl_len = sum([sge.length for sge in self.sgl])
+        self.inline_data = None # The SGL data copied at post time if SEND_FLAGS.INLINE
         self.wr_id = wr_id
         self.rmt_va = rmt_va
         self.remote_key = rkey
         self.compare_add_data = compare_add
         self.swap_data = swap
         self.imm_data_inv_rkey = imm_data_or_inv_rkey
+        # The destination of UD send WR
+        self.ah = ah
+        self.remote_qpn = remote_qpn
+        self.remote_qkey = remote_qkey
 
     def id(self):
         return self.wr_id
 
     def len(self):
-        return self.sgl.len()
+        return self.sgl_len
 
     def op(self):
         return self.opcode
 
+    # The first SGE, the only one for atomic
     def lkey(self):
-        # TODO: handle the case of sgl is None
-        return self.sgl.lkey()
+        # TODO: handle the case of sgl is empty
+        return self.sgl[0].lkey()
 
     def rkey(self):
         return self.remote_key
 
     def laddr(self):
-        return self.sgl.addr()
+        return self.sgl[0].addr()
 
     def raddr(self):
         return self.rmt_va
@@ -508,32 +875,226 @@ class SendWR:
     def swap(self):
         return self.swap_data
 
+    def dest_ah(self):
+        return self.ah
+
+    def dqpn(self):
+        return self.remote_qpn
+
+    def qkey(self):
+        return self.remote_qkey
+
 class RecvWR:
+    __slots__ = ('sgl', 'sgl_len', 'wr_id')
+
     def __init__(self, sgl, wr_id = 0):
-        self.sgl = sgl
+        self.sgl = Util.to_sge_list(sgl)
+        self.sgl_len = sum([sge.length for sge in self.sgl])
         self.wr_id = wr_id
 
     def id(self):
         return self.wr_id
 
+    def len(self):
+        return self.sgl_len
+
     def lkey(self):
-        return self.sgl.lkey()
+        return self.sgl[0].lkey()
 
     def addr(self):
-        return self.sgl.addr()
+        return self.sgl[0].addr()
+
+# The read responses of an outstanding read WR as a PSN interval,
+# each response PSN derives its remote VA and remaining DMA length
+class ReadRespCtx:
+    def __init__(self, read_ssn, orig_read_req_psn, resp_pkt_num, raddr, dlen, pmtu):
+        self.read_ssn = read_ssn
+        self.orig_read_req_psn = orig_read_req_psn # The first read response PSN
+        self.resp_pkt_num = resp_pkt_num
+        self.raddr = raddr
+        self.dlen = dlen
+        self.pmtu = pmtu
 
-# class ReadRespCtx:
-#     def __init__(self, read_wr, read_offset, read_ssn, orig_read_req_psn, resp_pkt_psn_dict):
-#         self.read_wr = read_wr
-#         self.read_offset = read_offset
-#         self.read_ssn = read_ssn
-#         self.orig_read_req_psn = orig_read_req_psn
-#         self.resp_pkt_psn_dict = resp_pkt_psn_dict
+    def resp_idx(self, resp_psn):
+        return (resp_psn - self.orig_read_req_psn) % MAX_PSN
+
+    def has_psn(self, resp_psn):
+        return self.resp_idx(resp_psn) < self.resp_pkt_num
+
+    def end_psn(self): # Not included
+        return (self.orig_read_req_psn + self.resp_pkt_num) % MAX_PSN
+
+    def resp_offset(self, resp_psn):
+        return self.resp_idx(resp_psn) * self.pmtu
+
+    # Return (remote VA, remaining DMA length, remaining response packet number) from resp_psn
+    def remaining_from(self, resp_psn):
+        resp_idx = self.resp_idx(resp_psn)
+        resp_offset = resp_idx * self.pmtu
+        return (self.raddr + resp_offset, self.dlen - resp_offset, self.resp_pkt_num - resp_idx)
+
+# A ring buffer indexed by sequence number (PSN or SSN) modulo its capacity,
+# each slot keeps its sequence number to tell live entry from empty slot.
+# The capacity doubles when two live sequence numbers map to the same slot,
+# the sequence space size should be power of 2 and no less than the capacity.
+class SeqRing:
+    def __init__(self, capacity = SEQ_RING_INIT_SIZE):
+        assert capacity > 0 and (capacity & (capacity - 1)) == 0, 'SeqRing capacity should be power of 2'
+        self.slots = [None] * capacity
+        self.mask = capacity - 1
+        self.size = 0
+
+    def grow(self):
+        old_slots = self.slots
+        self.slots = [None] * (len(old_slots) * 2)
+        self.mask = len(self.slots) - 1
+        for entry in old_slots:
+            if entry is not None:
+                self.slots[entry[0] & self.mask] = entry
+
+    def __setitem__(self, seq, val):
+        entry = self.slots[seq & self.mask]
+        while entry is not None and entry[0] != seq: # Slot taken by another live sequence number
+            self.grow()
+            entry = self.slots[seq & self.mask]
+        if entry is None:
+            self.size += 1
+        self.slots[seq & self.mask] = (seq, val)
+
+    def __getitem__(self, seq):
+        entry = self.slots[seq & self.mask]
+        if entry is None or entry[0] != seq:
+            raise KeyError(seq)
+        return entry[1]
+
+    def __delitem__(self, seq):
+        idx = seq & self.mask
+        entry = self.slots[idx]
+        if entry is None or entry[0] != seq:
+            raise KeyError(seq)
+        self.slots[idx] = None
+        self.size -= 1
+
+    def __contains__(self, seq):
+        entry = self.slots[seq & self.mask]
+        return entry is not None and entry[0] == seq
+
+    def __len__(self):
+        return self.size
+
+    def items(self): # In slot order, not sequence order
+        return [entry for entry in self.slots if entry is not None]
+
+    def clear(self):
+        self.slots = [None] * len(self.slots)
+        self.size = 0
+
+class TimerHandle:
+    def __init__(self, expire_tick, callback, args):
+        self.expire_tick = expire_tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+# A hierarchical timer wheel, each level has TIMER_WHEEL_SLOT_NUM slots, and a
+# slot of level N covers TIMER_WHEEL_SLOT_NUM^N ticks. A timer is put at the
+# lowest level where its expire tick shares the higher bits with current tick,
+# and moves down a level when current tick enters its slot. Schedule, cancel
+# and fire are O(1), cancelled timers are dropped when their slot is reached.
+class TimerWheel:
+    def __init__(self, tick_ns = TIMER_TICK_NS, slot_num = TIMER_WHEEL_SLOT_NUM, level_num = TIMER_WHEEL_LEVEL_NUM):
+        assert slot_num > 0 and (slot_num & (slot_num - 1)) == 0, 'TimerWheel slot number should be power of 2'
+        self.tick_ns = tick_ns
+        self.slot_bits = slot_num.bit_length() - 1
+        self.slot_mask = slot_num - 1
+        self.levels = [[[] for slot_idx in range(slot_num)] for level in range(level_num)]
+        self.cur_tick = self.now_tick() # All ticks up to cur_tick are processed
+        self.timer_num = 0 # Not including cancelled timers
+        self.wakeup = None # Called with the expire time in ns of each new timer, to re-arm external event loop
+
+    def now_tick(self):
+        return time.monotonic_ns() // self.tick_ns
+
+    def add(self, timer):
+        expire_tick = timer.expire_tick
+        top_level = len(self.levels) - 1
+        level = 0
+        while level < top_level and (expire_tick >> (self.slot_bits * (level + 1))) != (self.cur_tick >> (self.slot_bits * (level + 1))):
+            level += 1
+        self.levels[level][(expire_tick >> (self.slot_bits * level)) & self.slot_mask].append(timer)
+
+    def schedule(self, delay_ns, callback, *args):
+        if self.timer_num == 0: # Nothing to fire, catch up with now
+            self.cur_tick = max(self.cur_tick, self.now_tick())
+        expire_tick = max(-(-(time.monotonic_ns() + delay_ns) // self.tick_ns), self.cur_tick + 1) # Round up, never expire early
+        timer = TimerHandle(expire_tick, callback, args)
+        self.add(timer)
+        self.timer_num += 1
+        if self.wakeup is not None:
+            self.wakeup(expire_tick * self.tick_ns)
+        return timer
+
+    def cancel(self, timer):
+        if not timer.cancelled:
+            timer.cancel()
+            self.timer_num -= 1
+
+    # Fire all expired timers
+    def advance(self):
+        now_tick = self.now_tick()
+        while self.cur_tick < now_tick:
+            if self.timer_num == 0: # Nothing to fire, jump to now
+                self.cur_tick = now_tick
+                break
+            self.cur_tick += 1
+            self.cascade()
+            slot_idx = self.cur_tick & self.slot_mask
+            expired_timers = self.levels[0][slot_idx]
+            self.levels[0][slot_idx] = []
+            for timer in expired_timers:
+                if not timer.cancelled:
+                    timer.cancelled = True # Fired timer cannot be cancelled
+                    self.timer_num -= 1
+                    timer.callback(*timer.args)
+
+    # Move timers down from higher level slots that current tick enters
+    def cascade(self):
+        level = 1
+        while level < len(self.levels) and (self.cur_tick & ((1 << (self.slot_bits * level)) - 1)) == 0:
+            level += 1
+        for cascade_level in reversed(range(1, level)):
+            slot_idx = (self.cur_tick >> (self.slot_bits * cascade_level)) & self.slot_mask
+            cascade_timers = self.levels[cascade_level][slot_idx]
+            self.levels[cascade_level][slot_idx] = []
+            for timer in cascade_timers:
+                if not timer.cancelled:
+                    self.add(timer)
+
+    # Return the earliest time in ns to call advance(), or None if no timer,
+    # it might be earlier than the actual next expire time
+    def next_expire_ns(self):
+        if self.timer_num == 0:
+            return None
+        for level, slots in enumerate(self.levels):
+            level_shift = self.slot_bits * level
+            cur_slot_idx = (self.cur_tick >> level_shift) & self.slot_mask
+            for slot_idx in range(cur_slot_idx + 1, len(slots)):
+                if any(not timer.cancelled for timer in slots[slot_idx]):
+                    slot_tick = ((self.cur_tick >> (level_shift + self.slot_bits)) << (level_shift + self.slot_bits)) | (slot_idx << level_shift)
+                    return max(slot_tick, self.cur_tick + 1) * self.tick_ns
+        # Timers wrapped around the top level, wake up when current tick enters the next top level slot
+        top_level_shift = self.slot_bits * (len(self.levels) - 1)
+        return (((self.cur_tick >> top_level_shift) + 1) << top_level_shift) * self.tick_ns
 
 class PendingWRCtx:
+    __slots__ = ('wr', 'req_pkt_num', 'first_pkt_psn', 'retry_cnt', 'rnr_retry_cnt')
+
     def __init__(self, wr):
         self.wr = wr
-        self.wr_req_dict = {}
+        self.req_pkt_num = 0
         self.first_pkt_psn = None
         self.retry_cnt = 0
         self.rnr_retry_cnt = 0
@@ -544,20 +1105,20 @@ class PendingWRCtx:
     def rnr_retry_inc(self):
         self.rnr_retry_cnt += 1
 
+    # Request packets of a WR have consecutive PSN
     def add_pkt(self, pkt):
-        pkt_psn = pkt[BTH].psn
         if self.first_pkt_psn is None:
-            self.first_pkt_psn = pkt_psn
-        self.wr_req_dict[pkt_psn] = pkt
+            self.first_pkt_psn = pkt[BTH].psn
+        self.req_pkt_num += 1
 
     def pkt_num(self):
-        return len(self.wr_req_dict)
+        return self.req_pkt_num
 
     def first_psn(self):
         return self.first_pkt_psn
 
 class SQ:
-    def __init__(self, pd, cq, qpn, sq_psn, pmtu, access_flags, use_ipv6,
+    def __init__(self, pd, cq, qpn, sq_psn, pmtu, access_flags, tx, timer_wheel,
         pkey = DEFAULT_PKEY,
         draining = False,
         max_rd_atomic = 10,
@@ -566,8 +1127,16 @@ class SQ:
         timeout = DEFAULT_TIMEOUT,
         retry_cnt = 3,
         rnr_retry = 3,
+        max_send_sge = DEFAULT_MAX_SGE,
+        max_inline_data = DEFAULT_MAX_INLINE_DATA,
+        qp_type = QPT.RC,
     ):
         self.sq = []
+        self.qp_type = qp_type
+        self.ackreq_freq = DEFAULT_ACKREQ_FREQ
+        self.unreq_pkt_num = 0 # The number of request packets sent since the last one asked for ACK
+        self.max_send_sge = max_send_sge
+        self.max_inline_data = max_inline_data
         self.qps = QPS.INIT
         self.pd = pd # TODO: check pd match for each req
         self.cq = cq
@@ -581,6 +1150,7 @@ class SQ:
         self.dst_qpn = None
         self.access_flags = access_flags
         self.pkey = pkey
+        self.qkey = DEFAULT_QKEY # UD only
         self.draining = draining
         self.max_rd_atomic = max_rd_atomic
         self.max_dest_rd_atomic = max_dest_rd_atomic
@@ -589,25 +1159,35 @@ class SQ:
         self.retry_cnt = retry_cnt
         self.rnr_retry = rnr_retry
 
-        self.use_ipv6 = use_ipv6
+        self.tx = tx
+        self.tx_flow = None
         self.min_unacked_psn = self.sq_psn
 
-        self.outstanding_wr_dict = {} # The WR SSN -> (WR, dict(req_pkt_psn -> retry_num))
-        self.req_pkt_psn_wr_ssn_dict = {} # The request packet PSN -> WR SSN
-        self.read_resp_psn_wr_ssn_dict = {} # The read response packet PSN -> (read WR SSN, read request PSN)
-        self.read_ctx_dict = {}
+        self.outstanding_wr_ring = SeqRing() # The WR SSN -> PendingWRCtx
+        self.req_pkt_ring = SeqRing() # The request packet PSN -> (WR SSN, request packet)
+        self.read_ctx_dict = {} # The read WR SSN -> ReadRespCtx, in PSN order
 
         self.oldest_sent_ts_ns = None # Keep track of the oldest sent packet
         self.pending_rd_atomic_wr_num = 0
+        # The max SSN of WR consuming receive WQE allowed to send, MSN + credits advertised by
+        # the responder, None means no flow control until the responder advertises valid credits
+        self.credit_limit_ssn = None
+        self.probe_ssn = None # The WR sent without credit to probe for credits
+
+        self.timer_wheel = timer_wheel
+        self.retry_timer = None # The retransmit timer
+        self.rnr_timer = None # The RNR NAK wait timer, supersedes retransmit timer
 
     def modify(self,
         qps = None,
         pmtu = None,
         sq_psn = None,
         dgid = None,
+        tx_flow = None,
         dst_qpn = None,
         access_flags = None,
         pkey = None,
+        qkey = None,
         sq_draining = None,
         max_rd_atomic = None,
         max_dest_rd_atomic = None,
@@ -615,6 +1195,7 @@ class SQ:
         timeout = None,
         retry_cnt = None,
         rnr_retry = None,
+        ackreq_freq = None,
     ):
         if qps is not None:
             self.qps = qps
@@ -625,12 +1206,16 @@ class SQ:
             self.min_unacked_psn = self.sq_psn # min_unacked_psn should be updated each time sq_psn updated
         if dgid is not None:
             self.dgid = dgid
+        if tx_flow is not None:
+            self.tx_flow = tx_flow # The destination resolved from dgid
         if dst_qpn is not None:
             self.dst_qpn = dst_qpn # qpn in number instread of hex string
         if access_flags is not None:
             self.access_flags = access_flags
         if pkey is not None:
             self.pkey = pkey
+        if qkey is not None:
+            self.qkey = qkey
         if sq_draining is not None:
             self.sq_draining = sq_draining
         if max_rd_atomic is not None:
@@ -645,31 +1230,48 @@ class SQ:
             self.retry_cnt = retry_cnt
         if rnr_retry is not None:
             self.rnr_retry = rnr_retry
+        if ackreq_freq is not None:
+            self.ackreq_freq = ackreq_freq
 
     def push(self, wr):
         assert self.qps == QPS.RTS, 'QP state is not RTS'
-        wr_op = wr.op()
+        wr_op = wr.opcode
         # TODO: handle immediate errors, unsupported opcode
         assert WR_OPCODE.send(wr_op) or WR_OPCODE.write(wr_op) or WR_OPCODE.atomic(wr_op) or wr_op == WR_OPCODE.RDMA_READ, 'send WR has unsupported opcode'
+        assert self.qp_type == QPT.RC or WR_OPCODE.send(wr_op) or WR_OPCODE.write(wr_op), 'UC QP only supports send and write'
+        if self.qp_type == QPT.UD:
+            # TODO: handle immediate errors
+            assert wr_op in [WR_OPCODE.SEND, WR_OPCODE.SEND_WITH_IMM], 'UD QP only supports send and send with immediate'
+            assert wr.ah is not None and wr.remote_qpn is not None, 'UD send WR requires AH and remote QPN'
+            assert wr.sgl_len <= self.pmtu, 'UD send WR data size exceeds PMTU'
         # TODO: handle immediate errors
-        if wr.op() in [WR_OPCODE.SEND_WITH_IMM, WR_OPCODE.SEND_WITH_INV, WR_OPCODE.RDMA_WRITE_WITH_IMM]:
-            assert wr.imm_data_or_inv_rkey(), 'send/write with immediate data or send with invalidate requires send WR has imm_data_or_inv_rkey'
-        if WR_OPCODE.atomic(wr.op()):
-            assert wr.len() >= ATOMIC_BYTE_SIZE, 'atomic WR has no enough buffer length to receive atomic response'
-        if wr.len() > 0:
-            local_key = wr.lkey()
+        if wr.opcode in [WR_OPCODE.SEND_WITH_IMM, WR_OPCODE.SEND_WITH_INV, WR_OPCODE.RDMA_WRITE_WITH_IMM]:
+            assert wr.imm_data_inv_rkey, 'send/write with immediate data or send with invalidate requires send WR has imm_data_or_inv_rkey'
+        if WR_OPCODE.atomic(wr.opcode):
+            assert wr.sgl and wr.sgl[0].length >= ATOMIC_BYTE_SIZE, 'atomic WR has no enough buffer length to receive atomic response'
+        # TODO: handle immediate error
+        assert len(wr.sgl) <= self.max_send_sge, 'send WR has too many SGEs'
+        for sge in wr.sgl:
+            if sge.length > 0:
+                # TODO: handle immediate error
+                assert self.pd.has_mr(sge.local_key), 'send WR has invalid lkey'
+                mr = self.pd.get_mr(sge.local_key)
+                # TODO: handle immediate error
+                assert sge.pos_in_mr + sge.length <= mr.len(), 'send WR local SG is not within its MR'
+        if SEND_FLAGS.INLINE & wr.send_flags:
             # TODO: handle immediate error
-            assert self.pd.has_mr(local_key), 'send WR has invalid lkey'
-            mr = self.pd.get_mr(local_key)
-            # TODO: handle immediate error
-            assert wr.laddr() + wr.len() <= mr.len(), 'send WR local SG is not within its MR'
+            assert WR_OPCODE.send(wr_op) or WR_OPCODE.write(wr_op), 'only send and write WR support inline data'
+            assert wr.sgl_len <= self.max_inline_data, 'send WR inline data exceeds max_inline_data'
+            # Copy data at post time, so the buffer can be reused right after post,
+            # and the SQ packetizes the copy without reading MR again
+            wr.inline_data = b''.join([self.pd.get_mr(sge.local_key).read(addr = sge.pos_in_mr, size = sge.length) for sge in wr.sgl if sge.length > 0])
         
         self.sq.append(wr)
 
     def pop(self):
         wr = self.sq.pop(0)
         cssn = self.ssn
-        self.outstanding_wr_dict[cssn] = PendingWRCtx(wr)
+        self.outstanding_wr_ring[cssn] = PendingWRCtx(wr)
         self.ssn = (self.ssn + 1) % MAX_SSN
         return (wr, cssn)
 
@@ -699,122 +1301,222 @@ class SQ:
                 return False
 
     def handle_dup_or_illegal_resp(self, resp):
-        if self.min_unacked_psn == self.sq_psn: # No response expected
-            logging.info(f'SQ={self.sqpn()} received ghost response: ' + resp.show(dump = True))
-        else: # SQ discard duplicate or illegal response, except for unsolicited flow control credit
+        if Util.next_psn(resp[BTH].psn) == self.min_unacked_psn and resp[BTH].opcode == RC.ACKNOWLEDGE and resp[AETH].code == 0:
+            # Unsolicited flow control credit, an ACK of the latest ACK-ed PSN
+            self.update_credit(resp[AETH])
+            logging.debug(f'SQ={self.sqpn()} received unsolicited flow control credit={resp[AETH].value}')
+        elif self.min_unacked_psn == self.sq_psn: # No response expected
+            logging.info('SQ=%s received ghost response: %s', self.sqpn(), PktTrace(resp))
+        else: # SQ discard duplicate or illegal response
             psn_comp_res = Util.psn_compare(resp[BTH].psn, self.min_unacked_psn, self.sq_psn)
             assert psn_comp_res != 0, 'should handle duplicate or illegal response'
             if psn_comp_res < 0: # Dup resp
-                logging.debug(f'SQ={self.sqpn()} received duplicate response: ' + resp.show(dump = True))
-                nxt_psn = Util.next_psn(resp[BTH].psn)
-                if nxt_psn == self.min_unacked_psn: # Unsolicited flow control credit
-                    assert AETH in resp, 'unsolicited flow control credit ACK should have AETH'
-                    assert resp[AETH].code == 0, 'unsolicited flow control credit ACK code should be 0'
-                    credit_cnt = resp[AETH].value
-                    logging.debug(f'SQ={self.sqpn()} received unsolicited flow control credit={credit_cnt}')
+                logging.debug('SQ=%s received duplicate response: %s', self.sqpn(), PktTrace(resp))
             else: # Illegal response, just discard
                 assert Util.psn_compare(self.sq_psn, resp[BTH].psn, self.sq_psn) <= 0, 'should handle illegal response'
-                logging.debug(f'SQ={self.sqpn()} received illegal response: ' + resp.show(dump = True))
+                logging.debug('SQ=%s received illegal response: %s', self.sqpn(), PktTrace(resp))
+
+    # The AETH of ACK and read/atomic response advertises the responder credits
+    def update_credit(self, aeth):
+        if aeth.value == CREDIT_CNT_INVALID: # No flow control, e.g. the responder uses SRQ
+            self.credit_limit_ssn = None
+        else:
+            self.credit_limit_ssn = (aeth.msn + AETH_CREDIT_TABLE[aeth.value]) % MAX_SSN
+
+    # Send and write with immediate consume receive WQE, they need credit
+    def has_credit(self, wr):
+        wr_op = wr.opcode
+        if self.credit_limit_ssn is None or not (WR_OPCODE.send(wr_op) or wr_op == WR_OPCODE.RDMA_WRITE_WITH_IMM):
+            return True
+        return (self.credit_limit_ssn - self.ssn) % MAX_SSN < MAX_SSN // 2 # SSN <= credit_limit_ssn
+
+    # The same credit and read/atomic checks as process_one, for wr at the head of SQ
+    def can_process(self, wr):
+        if self.qp_type == QPT.UD:
+            return True
+        if self.qp_type == QPT.RC and not self.has_credit(wr):
+            if self.probe_ssn is not None and self.probe_ssn in self.outstanding_wr_ring:
+                return False
+        return self.pending_rd_atomic_wr_num < self.max_dest_rd_atomic
 
     def process_one(self):
+        if self.qp_type == QPT.UD: # The destination is per WR
+            sr, cssn = self.pop()
+            self.process_ud_send_req(sr, cssn)
+            self.complete_unreliable_wr(sr, cssn)
+            return True
         if not self.dqpn():
             raise Exception(f'SQ={self.sqpn()} has no destination QPN')
-        elif not self.dgid:
+        elif not self.tx_flow:
             raise Exception(f'SQ={self.sqpn()} has no destination GID')
-        self.check_timeout_and_retry() # Check request timeout and retry if any
 
+        credit_probe = False
+        if self.qp_type == QPT.RC and not self.has_credit(self.sq[0]):
+            if self.probe_ssn is not None and self.probe_ssn in self.outstanding_wr_ring:
+                logging.debug(f'SQ={self.sqpn()} has no credit to send WR with SSN={self.ssn}, credit limit SSN={self.credit_limit_ssn}')
+                return False
+            # Without credit, one WR at a time is sent as a probe, it always asks for ACK,
+            # which advertises new credits, or it gets a RNR NAK and is retried
+            credit_probe = True
         if self.pending_rd_atomic_wr_num < self.max_dest_rd_atomic:
             sr, cssn = self.pop()
+            if credit_probe:
+                self.probe_ssn = cssn
             read_or_atomic = False
-            if WR_OPCODE.send(sr.op()):
+            if WR_OPCODE.send(sr.opcode):
                 self.process_send_req(sr, cssn)
-            elif WR_OPCODE.write(sr.op()):
+            elif WR_OPCODE.write(sr.opcode):
                 self.process_write_req(sr, cssn)
             elif WR_OPCODE.RDMA_READ == sr.opcode:
                 self.process_read_req(sr, cssn)
                 read_or_atomic = True
-            elif WR_OPCODE.atomic(sr.op()):
+            elif WR_OPCODE.atomic(sr.opcode):
                 self.process_atomic_req(sr, cssn)
                 read_or_atomic = True
             else:
                 raise Exception(f'SQ={self.sqpn()} met unsupported opcode: {sr.opcode}')
 
+            if self.qp_type == QPT.UC:
+                self.complete_unreliable_wr(sr, cssn)
+                return True
             if read_or_atomic:
                 self.pending_rd_atomic_wr_num += 1
-            if read_or_atomic or (SEND_FLAGS.SIGNALED & sr.flags()):
+            if read_or_atomic or credit_probe or (SEND_FLAGS.SIGNALED & sr.send_flags):
                 self.update_oldest_sent_ts(ack_or_timeout = False) # Update oldest_sent_ts if is None
             return True
         else:
             logging.debug(f'SQ={self.sqpn()} has sent too many requests, {self.pending_rd_atomic_wr_num} outstanding read/atomic requests')
             return False
 
+    # UC and UD WR completes once sent, no ACK to wait for
+    def complete_unreliable_wr(self, sr, cssn):
+        del self.outstanding_wr_ring[cssn]
+        if SEND_FLAGS.SIGNALED & sr.send_flags:
+            cqe = CQE(
+                wr_id = sr.wr_id,
+                status = WC_STATUS.SUCCESS,
+                opcode = WC_OPCODE.from_wr_op(sr.opcode),
+                length = sr.sgl_len,
+                qpn = self.sqpn(),
+                src_qp = sr.remote_qpn if self.qp_type == QPT.UD else self.dqpn(),
+                wc_flags = EMPTY_WC_FLAG,
+            )
+            self.cq.push(cqe)
+
     # There are 4 case to delete outstanding WQE:
     # - ACK received, delete finished send or write WR
     # - unrecoverable NAK received, delete NAK related WR
     # - read response received, delete finished read WR
     # - atomic response received, delete finished atomic WR
     def rm_outstanding_wr(self, ssn_to_delete):
-        wr_ctx = self.outstanding_wr_dict[ssn_to_delete]
+        wr_ctx = self.outstanding_wr_ring[ssn_to_delete]
         wr_to_delete = wr_ctx.wr
-        wr_req_dict = wr_ctx.wr_req_dict
         wr_op = wr_to_delete.op()
         if wr_op == WR_OPCODE.RDMA_READ or WR_OPCODE.atomic(wr_op):
             self.pending_rd_atomic_wr_num -= 1
             assert self.pending_rd_atomic_wr_num >= 0, 'pending_rd_atomic_wr_num should not < 0'
         if wr_op == WR_OPCODE.RDMA_READ: # Clean up read response context
-            read_offset, resp_pkt_psn_dict = self.read_ctx_dict[ssn_to_delete]
-            # Cleanup finished read response PSN
-            for resp_pkt_psn in resp_pkt_psn_dict.keys():
-                del self.read_resp_psn_wr_ssn_dict[resp_pkt_psn]
-            resp_pkt_psn_dict.clear()
             del self.read_ctx_dict[ssn_to_delete]
         # Clean up finished request PSN
-        for req_pkt_psn in wr_req_dict.keys():
-            del self.req_pkt_psn_wr_ssn_dict[req_pkt_psn]
-        wr_req_dict.clear()
-        del self.outstanding_wr_dict[ssn_to_delete]
+        if wr_ctx.req_pkt_num:
+            for req_pkt_psn in Util.psn_range(wr_ctx.first_pkt_psn, (wr_ctx.first_pkt_psn + wr_ctx.req_pkt_num) % MAX_PSN):
+                del self.req_pkt_ring[req_pkt_psn]
+        del self.outstanding_wr_ring[ssn_to_delete]
 
     def get_outstanding_wr(self, pending_wr_ssn):
-        pending_wr_ctx = self.outstanding_wr_dict[pending_wr_ssn]
+        pending_wr_ctx = self.outstanding_wr_ring[pending_wr_ssn]
         return pending_wr_ctx.wr
 
     def send_pkt(self, wr_ssn, req_pkt, retry_type = NO_RETRY):
+        if self.qp_type == QPT.UC: # No ACK and retransmit, so the request packet is not saved
+            req_pkt[BTH].opcode |= TRANSPORT_UC
+            req_pkt[BTH].ackreq = False
+            logging.debug('SQ=%s sent to IP=%s a request: %s', self.sqpn(), self.tx_flow.dst_ip(), PktTrace(req_pkt))
+            self.tx.send(self.tx_flow, req_pkt)
+            return
+
         req_pkt_psn = req_pkt[BTH].psn
-        rc_op = req_pkt[BTH].psn
-        wr_ctx = self.outstanding_wr_dict[wr_ssn]
+        rc_op = req_pkt[BTH].opcode
+        wr_ctx = self.outstanding_wr_ring[wr_ssn]
         if retry_type:
             if retry_type == RNR_RETRY:
                 wr_ctx.rnr_retry_inc()
             else:
                 wr_ctx.other_retry_inc()
+            # With ackreq_freq > 1, the last packet may have been sent without ackreq, and if it was lost,
+            # the responder takes the retry as new and does not ACK it, so the retry always asks for ACK
+            if RC.last_req_pkt(rc_op) or RC.only_req_pkt(rc_op):
+                req_pkt[BTH].ackreq = True
         else:
-            self.req_pkt_psn_wr_ssn_dict[req_pkt_psn] = (wr_ssn, req_pkt)
+            self.req_pkt_ring[req_pkt_psn] = (wr_ssn, req_pkt)
             wr_ctx.add_pkt(req_pkt)
 
-        # ip_hex = socket.inet_aton('192.168.122.190').hex()
-        # dst_ipv6 = socket.inet_ntop(socket.AF_INET6, bytes.fromhex(self.dgid))
-        dst_ipv6 = socket.inet_ntop(socket.AF_INET6, self.dgid)
-        dst_ipv4 = dst_ipv6.replace('::ffff:', '')
-        dst_ip = dst_ipv6 if self.use_ipv6 else dst_ipv4
-
-        pkt_l3 = IP(dst=dst_ip)/UDP(dport=ROCE_PORT, sport=self.sqpn())/req_pkt
-        logging.debug(f'SQ={self.sqpn()} sent to IP={dst_ip} a request: ' + pkt_l3.show(dump = True))
-        send(pkt_l3)
+        logging.debug('SQ=%s sent to IP=%s a request: %s', self.sqpn(), self.tx_flow.dst_ip(), PktTrace(req_pkt))
+        self.tx.send(self.tx_flow, req_pkt)
+
+    # Split the data of SGL into payloads of PMTU size, the MR is read per payload,
+    # and a payload across SGEs is gathered without copy. The pad is appended to the last payload.
+    def gather_payloads(self, sgl, pad = 0):
+        payload_list = []
+        buf_list = []
+        buf_size = 0
+        for sge in sgl:
+            if sge.length == 0:
+                continue
+            mr = self.pd.get_mr(sge.local_key)
+            sge_pos = 0
+            while sge_pos < sge.length:
+                read_size = min(self.pmtu - buf_size, sge.length - sge_pos)
+                buf_list.append(mr.read(addr = sge.pos_in_mr + sge_pos, size = read_size))
+                buf_size += read_size
+                sge_pos += read_size
+                if buf_size == self.pmtu:
+                    payload_list.append(buf_list[0] if len(buf_list) == 1 else Gather(buf_list))
+                    buf_list = []
+                    buf_size = 0
+        if pad:
+            buf_list.append(bytes(pad))
+        if buf_list:
+            payload_list.append(buf_list[0] if len(buf_list) == 1 else Gather(buf_list))
+        return payload_list
+
+    # Split inline data into payloads of PMTU size, no MR involved
+    def split_inline_payloads(self, inline_data, pad = 0):
+        inline_view = memoryview(inline_data)
+        payload_list = [inline_view[pos : (pos + self.pmtu)] for pos in range(0, len(inline_data), self.pmtu)]
+        if pad:
+            payload_list[-1] = Gather([payload_list[-1], bytes(pad)])
+        return payload_list
+
+    # Decide whether the last packet of a send or write WR asks for ACK. With ackreq_freq K > 1,
+    # it asks once at least K packets were sent without asking, or a signaled WR makes SQ idle,
+    # so the responder sends about one ACK every K packets and the last WR is always ACK-ed
+    def need_ackreq(self, sr, cssn, req_pkt_num):
+        if cssn == self.probe_ssn: # Credit probe
+            self.unreq_pkt_num = 0
+            return True
+        signaled = bool(SEND_FLAGS.SIGNALED & sr.send_flags)
+        if self.ackreq_freq <= 1:
+            return signaled
+        self.unreq_pkt_num += req_pkt_num
+        if self.unreq_pkt_num >= self.ackreq_freq or (signaled and self.empty()):
+            self.unreq_pkt_num = 0
+            return True
+        return False
 
     def process_send_req(self, sr, cssn):
-        assert WR_OPCODE.send(sr.op()), 'should be send operation'
-        addr = sr.laddr()
-        send_size = sr.len()
-        send_data = b''
-        if send_size:
-            mr = self.pd.get_mr(sr.lkey())
-            send_data = mr.read(addr = addr, size = send_size)
-
-        send_req_pkt_num = math.ceil(sr.len() / self.pmtu) if send_size > 0 else 1
+        assert WR_OPCODE.send(sr.opcode), 'should be send operation'
+        send_size = sr.sgl_len
+        if sr.inline_data is not None:
+            send_data = self.split_inline_payloads(sr.inline_data)
+        else:
+            send_data = self.gather_payloads(sr.sgl)
+
+        send_req_pkt_num = math.ceil(send_size / self.pmtu) if send_size > 0 else 1
         cpsn = self.sq_psn
         dqpn = self.dqpn()
-        ackreq = True if SEND_FLAGS.SIGNALED & sr.flags() else False
-        solicited = True if SEND_FLAGS.SOLICITED & sr.flags() else False
+        ackreq = self.need_ackreq(sr, cssn, send_req_pkt_num)
+        solicited = True if SEND_FLAGS.SOLICITED & sr.send_flags else False
 
         if send_req_pkt_num > 1:
             send_bth = BTH(
@@ -824,76 +1526,104 @@ class SQ:
                 ackreq = False,
                 solicited = False,
             )
-            send_req = send_bth/Raw(load = send_data[0 : self.pmtu])
+            send_req = send_bth/Raw(load = send_data[0])
             self.send_pkt(cssn, send_req)
 
             send_req_mid_pkt_num = send_req_pkt_num - 2
             for i in range(send_req_mid_pkt_num):
                 send_bth = BTH(
                     opcode = RC.SEND_MIDDLE,
-                    psn = cpsn + i + 1,
+                    psn = (cpsn + i + 1) % MAX_PSN,
                     dqpn = dqpn,
                     ackreq = False,
                     solicited = False,
                 )
-                send_req = send_bth/Raw(load = send_data[((i + 1) * self.pmtu) : ((i + 2) * self.pmtu)])
+                send_req = send_bth/Raw(load = send_data[i + 1])
                 self.send_pkt(cssn, send_req)
 
         rc_op = None
         if send_req_pkt_num == 1:
-            if sr.op() == WR_OPCODE.SEND_WITH_IMM:
+            if sr.opcode == WR_OPCODE.SEND_WITH_IMM:
                 rc_op = RC.SEND_ONLY_WITH_IMMEDIATE
-            elif sr.op() == WR_OPCODE.SEND_WITH_INV:
+            elif sr.opcode == WR_OPCODE.SEND_WITH_INV:
                 rc_op = RC.SEND_ONLY_WITH_INVALIDATE
             else:
                 rc_op = RC.SEND_ONLY
         else:
-            if sr.op() == WR_OPCODE.SEND_WITH_IMM:
+            if sr.opcode == WR_OPCODE.SEND_WITH_IMM:
                 rc_op = RC.SEND_LAST_WITH_IMMEDIATE
-            elif sr.op() == WR_OPCODE.SEND_WITH_INV:
+            elif sr.opcode == WR_OPCODE.SEND_WITH_INV:
                 rc_op = RC.SEND_LAST_WITH_INVALIDATE
             else:
                 rc_op = RC.SEND_LAST
         send_bth = BTH(
             opcode = rc_op,
-            psn = cpsn + send_req_pkt_num - 1,
+            psn = (cpsn + send_req_pkt_num - 1) % MAX_PSN,
             dqpn = dqpn,
             ackreq = ackreq,
             solicited = solicited,
         )
         send_req = None
         if RC.has_imm(rc_op):
-            imm_data = ImmDt(data = sr.imm_data_or_inv_rkey())
+            imm_data = ImmDt(data = sr.imm_data_inv_rkey)
             send_req = send_bth/imm_data
         elif RC.has_inv(rc_op):
-            send_ieth = IETH(rkey = sr.imm_data_or_inv_rkey())
+            send_ieth = IETH(rkey = sr.imm_data_inv_rkey)
             send_req = send_bth/send_ieth
         else:
             send_req = send_bth
         if send_size > 0:
-            raw_pkt = Raw(load = send_data[((send_req_pkt_num - 1) * self.pmtu) : send_size])
+            raw_pkt = Raw(load = send_data[send_req_pkt_num - 1])
             send_req = send_req/raw_pkt
         self.send_pkt(cssn, send_req)
         self.sq_psn = (self.sq_psn + send_req_pkt_num) % MAX_PSN
 
+    # UD message is a single send packet with DETH, to the AH and QPN of the WR
+    def process_ud_send_req(self, sr, cssn):
+        send_size = sr.sgl_len
+        # Add pad
+        pad = (4 - (send_size % 4)) % 4
+        if sr.inline_data is not None:
+            send_data = self.split_inline_payloads(sr.inline_data, pad)
+        else:
+            send_data = self.gather_payloads(sr.sgl, pad)
+
+        rc_op = RC.SEND_ONLY_WITH_IMMEDIATE if sr.opcode == WR_OPCODE.SEND_WITH_IMM else RC.SEND_ONLY
+        send_bth = BTH(
+            opcode = TRANSPORT_UD | rc_op,
+            psn = self.sq_psn,
+            dqpn = sr.remote_qpn,
+            ackreq = False,
+            solicited = True if SEND_FLAGS.SOLICITED & sr.send_flags else False,
+            padcount = pad,
+        )
+        qkey = self.qkey if sr.remote_qkey is None or (QKEY_USE_QP & sr.remote_qkey) else sr.remote_qkey
+        send_req = send_bth/DETH(qkey = qkey, sqpn = self.sqpn())
+        if RC.has_imm(rc_op):
+            send_req = send_req/ImmDt(data = sr.imm_data_inv_rkey)
+        if send_data:
+            send_req = send_req/Raw(load = send_data[0])
+        logging.debug('SQ=%s sent to IP=%s a request: %s', self.sqpn(), sr.ah.dst_ip(), PktTrace(send_req))
+        self.tx.send(sr.ah.tx_flow, send_req)
+        self.sq_psn = (self.sq_psn + 1) % MAX_PSN
+
     def process_write_req(self, sr, cssn):
-        assert WR_OPCODE.write(sr.op()), 'should be write operation'
-        addr = sr.laddr()
-        write_size = sr.len()
+        assert WR_OPCODE.write(sr.opcode), 'should be write operation'
+        write_size = sr.sgl_len
         # Add pad
         pad = (4 - (write_size % 4)) % 4
-        write_data = b''
-        if write_size:
-            mr = self.pd.get_mr(sr.lkey())
-            write_data = mr.read(addr = addr, size = (write_size + pad))
+        if sr.inline_data is not None:
+            write_data = self.split_inline_payloads(sr.inline_data, pad)
+        else:
+            write_data = self.gather_payloads(sr.sgl, pad)
 
         write_req_pkt_num = math.ceil(write_size / self.pmtu) if write_size else 1
         cpsn = self.sq_psn
         dqpn = self.dqpn()
-        ackreq = True if SEND_FLAGS.SIGNALED & sr.flags() else False
+        ackreq = self.need_ackreq(sr, cssn, write_req_pkt_num)
         solicited = False
 
-        write_reth = RETH(va = sr.raddr(), rkey = sr.rkey(), dlen = write_size)
+        write_reth = RETH(va = sr.rmt_va, rkey = sr.remote_key, dlen = write_size)
         if write_req_pkt_num > 1:
             write_bth = BTH(
                 opcode = RC.RDMA_WRITE_FIRST,
@@ -902,38 +1632,38 @@ class SQ:
                 ackreq = False,
                 solicited = False,
             )
-            write_req = write_bth/write_reth/Raw(load = write_data[0 : self.pmtu])
+            write_req = write_bth/write_reth/Raw(load = write_data[0])
             self.send_pkt(cssn, write_req)
 
             write_req_mid_pkt_num = write_req_pkt_num - 2
             for i in range(write_req_mid_pkt_num):
                 write_bth = BTH(
                     opcode = RC.RDMA_WRITE_MIDDLE,
-                    psn = cpsn + i + 1,
+                    psn = (cpsn + i + 1) % MAX_PSN,
                     dqpn = dqpn,
                     ackreq = False,
                     solicited = False,
                 )
-                write_req = write_bth/Raw(load = write_data[((i + 1) * self.pmtu) : ((i + 2) * self.pmtu)])
+                write_req = write_bth/Raw(load = write_data[i + 1])
                 self.send_pkt(cssn, write_req)
 
         rc_op = None
         solicited = False
         if write_req_pkt_num == 1:
-            if sr.op() == WR_OPCODE.RDMA_WRITE_WITH_IMM:
+            if sr.opcode == WR_OPCODE.RDMA_WRITE_WITH_IMM:
                 rc_op = RC.RDMA_WRITE_ONLY_WITH_IMMEDIATE
-                solicited = True if SEND_FLAGS.SOLICITED & sr.flags() else False
+                solicited = True if SEND_FLAGS.SOLICITED & sr.send_flags else False
             else:
                 rc_op = RC.RDMA_WRITE_ONLY
         else:
-            if sr.op() == WR_OPCODE.RDMA_WRITE_WITH_IMM:
+            if sr.opcode == WR_OPCODE.RDMA_WRITE_WITH_IMM:
                 rc_op = RC.RDMA_WRITE_LAST_WITH_IMMEDIATE
-                solicited = True if SEND_FLAGS.SOLICITED & sr.flags() else False
+                solicited = True if SEND_FLAGS.SOLICITED & sr.send_flags else False
             else:
                 rc_op = RC.RDMA_WRITE_LAST
         write_bth = BTH(
             opcode = rc_op,
-            psn = cpsn + write_req_pkt_num - 1,
+            psn = (cpsn + write_req_pkt_num - 1) % MAX_PSN,
             dqpn = dqpn,
             ackreq = ackreq,
             solicited = solicited,
@@ -943,28 +1673,28 @@ class SQ:
         if RC.only_req_pkt(rc_op):
             if RC.has_imm(rc_op):
                 # RDMA_WRITE_ONLY_WITH_IMMEDIATE use RETHImmDt, instead of RETH/ImmDt
-                reth_imm_data = RETHImmDt(va = sr.raddr(), rkey = sr.rkey(), dlen = write_size, data = sr.imm_data_or_inv_rkey())
+                reth_imm_data = RETHImmDt(va = sr.rmt_va, rkey = sr.remote_key, dlen = write_size, data = sr.imm_data_inv_rkey)
                 write_req = write_bth/reth_imm_data
             else:
                 write_req = write_bth/write_reth
         else:
             if RC.has_imm(rc_op):
-                imm_data = ImmDt(data = sr.imm_data_or_inv_rkey())
+                imm_data = ImmDt(data = sr.imm_data_inv_rkey)
                 write_req = write_bth/imm_data
             else:
                 write_req = write_bth
         if write_size > 0:
-            raw_pkt = Raw(load = write_data[((write_req_pkt_num - 1) * self.pmtu) : (write_size + pad)])
+            raw_pkt = Raw(load = write_data[write_req_pkt_num - 1])
             write_req = write_req/raw_pkt
         self.send_pkt(cssn, write_req)
         self.sq_psn = (self.sq_psn + write_req_pkt_num) % MAX_PSN
 
     def process_read_req(self, sr, cssn):
-        assert sr.op() == WR_OPCODE.RDMA_READ, 'should be read operation'
+        assert sr.opcode == WR_OPCODE.RDMA_READ, 'should be read operation'
         # TODO: locally detected error: Local Memory Protection / Requester Class B
         assert ACCESS_FLAGS.LOCAL_WRITE & self.get_qp_access_flags(), 'read op should have write permission to local MR'
 
-        read_size = sr.len()
+        read_size = sr.sgl_len
         read_resp_pkt_num = math.ceil(read_size / self.pmtu) if read_size > 0 else 1
         cpsn = self.sq_psn
         dqpn = self.dqpn()
@@ -975,7 +1705,7 @@ class SQ:
             dqpn = dqpn,
             ackreq = True,
         )
-        read_reth = RETH(va = sr.raddr(), rkey = sr.rkey(), dlen = read_size)
+        read_reth = RETH(va = sr.rmt_va, rkey = sr.remote_key, dlen = read_size)
         read_req = read_bth/read_reth
         # Read request will be saved in self.sent_pkt_dict, and if read has multiple responses,
         # the returned read response have PSN > the PSN of the read request, therefore,
@@ -983,28 +1713,29 @@ class SQ:
         self.send_pkt(cssn, read_req)
         self.sq_psn = (self.sq_psn + read_resp_pkt_num) % MAX_PSN
 
-        # Save each read response PSN to read WR SSN mapping
-        resp_pkt_psn_dict = {}
-        resp_raddr = sr.raddr()
-        remaining_dlen = read_size
-        remaining_resp_pkt_num = read_resp_pkt_num
-        for read_resp_pkt_psn in Util.psn_range(cpsn, self.sq_psn):
-            self.read_resp_psn_wr_ssn_dict[read_resp_pkt_psn] = (cssn, cpsn)
-            resp_pkt_psn_dict[read_resp_pkt_psn] = (resp_raddr, remaining_dlen, remaining_resp_pkt_num)
-            resp_raddr += self.pmtu
-            remaining_dlen -= self.pmtu
-            remaining_resp_pkt_num -= 1
-        assert remaining_resp_pkt_num == 0, 'remaining_resp_pkt_num should == 0'
-        # Prepare read response context
-        read_offset = 0
-        self.read_ctx_dict[cssn] = (read_offset, resp_pkt_psn_dict)
+        # Prepare read response context, the read responses take PSN from cpsn to self.sq_psn (not included)
+        self.read_ctx_dict[cssn] = ReadRespCtx(
+            read_ssn = cssn,
+            orig_read_req_psn = cpsn,
+            resp_pkt_num = read_resp_pkt_num,
+            raddr = sr.rmt_va,
+            dlen = read_size,
+            pmtu = self.pmtu,
+        )
+
+    # Outstanding reads are few, limited by max_dest_rd_atomic
+    def find_read_ctx(self, resp_psn):
+        for read_ctx in self.read_ctx_dict.values():
+            if read_ctx.has_psn(resp_psn):
+                return read_ctx
+        return None
 
     def process_atomic_req(self, sr, cssn):
-        assert WR_OPCODE.atomic(sr.op()), 'should be atomic operation'
+        assert WR_OPCODE.atomic(sr.opcode), 'should be atomic operation'
         # TODO: handle locally detected error: Local Memory Protection / Requester Class B
         assert ACCESS_FLAGS.LOCAL_WRITE & self.get_qp_access_flags(), 'atomic op should have write permission to local MR'
 
-        rc_op = RC.COMPARE_SWAP if sr.op() == WR_OPCODE.ATOMIC_CMP_AND_SWP else RC.FETCH_ADD
+        rc_op = RC.COMPARE_SWAP if sr.opcode == WR_OPCODE.ATOMIC_CMP_AND_SWP else RC.FETCH_ADD
         cpsn = self.sq_psn
         dqpn = self.dqpn()
         atomic_bth = BTH(
@@ -1014,10 +1745,10 @@ class SQ:
             ackreq = True,
         )
         atomic_eth = AtomicETH(
-            va = sr.raddr(),
-            rkey = sr.rkey(),
-            comp = sr.comp(),
-            swap = sr.swap(),
+            va = sr.rmt_va,
+            rkey = sr.remote_key,
+            comp = sr.compare_add_data,
+            swap = sr.swap_data,
         )
         atomic_req = atomic_bth/atomic_eth
         self.send_pkt(cssn, atomic_req)
@@ -1027,6 +1758,11 @@ class SQ:
         rc_op = resp[BTH].opcode
         assert resp[BTH].dqpn == self.qpn, 'QPN not match with ACK packet'
         assert self.is_expected_resp(resp[BTH].psn), 'should expect valid response, not duplicate or illegal one'
+        if AETH in resp:
+            if resp[AETH].code == 0:
+                self.update_credit(resp[AETH])
+            elif resp[AETH].code == 1: # RNR NAK means no credit
+                self.credit_limit_ssn = resp[AETH].msn
         col_ack_res, psn_begin_retry, implicit_ack_pkt_num = self.coalesce_ack(resp[BTH].psn)
 
         if not col_ack_res: # There are read or atomic requests being implicitly NAK, should retry
@@ -1052,17 +1788,17 @@ class SQ:
         logging.debug(f'min unacked PSN={self.min_unacked_psn}, next PSN={self.sq_psn}, implicit_ack_pkt_num={implicit_ack_pkt_num}, pending_rd_atomic_wr_num={self.pending_rd_atomic_wr_num}')
 
     def retry_partial_read(self, partial_read_resp_psn, retry_type = OTHER_RETRY):
-        assert partial_read_resp_psn not in self.req_pkt_psn_wr_ssn_dict, 'partial_read_resp_psn should be a mid or last read request PSN and not in req_pkt_psn_wr_ssn_dict'
-        assert partial_read_resp_psn in self.read_resp_psn_wr_ssn_dict, 'incorrect NAK sequence error PSN to retry, it should be in read_resp_psn_wr_ssn_dict'
-        retry_read_wr_ssn, orig_read_req_psn = self.read_resp_psn_wr_ssn_dict[partial_read_resp_psn]
-        orig_read_wr_ssn, orig_read_req = self.req_pkt_psn_wr_ssn_dict[orig_read_req_psn]
-        assert orig_read_wr_ssn == orig_read_wr_ssn, 'orig_read_wr_ssn shoud == orig_read_wr_ssn'
+        assert partial_read_resp_psn not in self.req_pkt_ring, 'partial_read_resp_psn should be a mid or last read request PSN and not in req_pkt_ring'
+        read_ctx = self.find_read_ctx(partial_read_resp_psn)
+        assert read_ctx is not None, 'incorrect NAK sequence error PSN to retry, it should be within an outstanding read response PSN range'
+        orig_read_req_psn = read_ctx.orig_read_req_psn
+        orig_read_wr_ssn, orig_read_req = self.req_pkt_ring[orig_read_req_psn]
+        assert orig_read_wr_ssn == read_ctx.read_ssn, 'orig_read_wr_ssn shoud == read_ctx.read_ssn'
 
         # Build a new read request, but its PSN is within the range of the read response to the original read request
         retry_read_req = copy.deepcopy(orig_read_req)
-        read_offset, resp_pkt_psn_dict = self.read_ctx_dict[retry_read_wr_ssn]
         retry_read_req[BTH].psn = partial_read_resp_psn
-        (retry_read_req[RETH].va, retry_read_req[RETH].dlen, remaining_read_resp_pkt_num) = resp_pkt_psn_dict[partial_read_resp_psn]
+        (retry_read_req[RETH].va, retry_read_req[RETH].dlen, remaining_read_resp_pkt_num) = read_ctx.remaining_from(partial_read_resp_psn)
 
         assert retry_read_req[RETH].dlen != 0, 'retry read request DMA length should not be zero, otherwise no need to retry'
         self.send_pkt(orig_read_wr_ssn, retry_read_req, retry_type = retry_type)
@@ -1072,12 +1808,12 @@ class SQ:
         return next_request_psn
 
     def retry_one_wr(self, ssn_to_retry, psn_begin_retry = None, retry_type = OTHER_RETRY, retry_handler = None):
-        wr_ctx = self.outstanding_wr_dict[ssn_to_retry]
-        psn_end_retry = (wr_ctx.first_psn() + wr_ctx.pkt_num()) % MAX_PSN
+        wr_ctx = self.outstanding_wr_ring[ssn_to_retry]
+        psn_end_retry = (wr_ctx.first_pkt_psn + wr_ctx.req_pkt_num) % MAX_PSN
         if psn_begin_retry is None:
-            psn_begin_retry = wr_ctx.first_psn()
+            psn_begin_retry = wr_ctx.first_pkt_psn
         else:
-            assert Util.psn_compare(wr_ctx.first_psn(), psn_begin_retry, self.sq_psn) <= 0, 'wr_ctx.first_psn() should <= retry_from_psn'
+            assert Util.psn_compare(wr_ctx.first_pkt_psn, psn_begin_retry, self.sq_psn) <= 0, 'wr_ctx.first_pkt_psn should <= retry_from_psn'
             assert Util.psn_compare(psn_begin_retry, psn_end_retry, self.sq_psn) <= 0, 'retry_from_psn should <= retry_end_psn'
         self.retry_pkts(psn_begin_retry = psn_begin_retry, psn_end_retry = psn_end_retry, retry_type = retry_type, retry_handler = retry_handler)
 
@@ -1094,19 +1830,21 @@ class SQ:
         if retry_handler:
             retry_handler()
 
-        if psn_begin_retry not in self.req_pkt_psn_wr_ssn_dict: # psn_begin_retry is a partial read response PSN
+        if psn_begin_retry not in self.req_pkt_ring: # psn_begin_retry is a partial read response PSN
             psn_begin_retry = self.retry_partial_read(partial_read_resp_psn = psn_begin_retry, retry_type = retry_type)
 
-        for retry_psn in Util.psn_range(psn_begin_retry, psn_end_retry):
-            if retry_psn != psn_end_retry:
-                if retry_psn in self.req_pkt_psn_wr_ssn_dict:
-                    retry_wr_ssn, pkt_to_retry = self.req_pkt_psn_wr_ssn_dict[retry_psn]
-                    self.send_pkt(retry_wr_ssn, pkt_to_retry, retry_type = retry_type)
-                else:
-                    assert retry_psn in self.read_resp_psn_wr_ssn_dict, 'incorrect PSN, it should either in req_pkt_psn_wr_ssn_dict or read_resp_psn_wr_ssn_dict'
+        retry_psn = psn_begin_retry
+        while Util.psn_compare(retry_psn, psn_end_retry, self.sq_psn) < 0:
+            assert retry_psn in self.req_pkt_ring, 'incorrect PSN, it should either in req_pkt_ring or within read response PSN range'
+            retry_wr_ssn, pkt_to_retry = self.req_pkt_ring[retry_psn]
+            self.send_pkt(retry_wr_ssn, pkt_to_retry, retry_type = retry_type)
+            if retry_wr_ssn in self.read_ctx_dict: # Skip the read response PSN range
+                retry_psn = self.read_ctx_dict[retry_wr_ssn].end_psn()
+            else:
+                retry_psn = Util.next_psn(retry_psn)
 
     def ack_send_or_write_req(self, psn_to_ack):
-        pending_wr_ssn, pkt_to_ack = self.req_pkt_psn_wr_ssn_dict[psn_to_ack]
+        pending_wr_ssn, pkt_to_ack = self.req_pkt_ring[psn_to_ack]
         rc_op = pkt_to_ack[BTH].opcode
         
         if rc_op == RC.RDMA_READ_REQUEST or RC.atomic(rc_op):
@@ -1118,10 +1856,10 @@ class SQ:
             send_or_write_wr = self.get_outstanding_wr(pending_wr_ssn)
             # Generate CQE for each acked send or write WR
             cqe = CQE(
-                wr_id = send_or_write_wr.id(),
+                wr_id = send_or_write_wr.wr_id,
                 status = WC_STATUS.SUCCESS,
                 opcode = WC_OPCODE.from_rc_op(rc_op),
-                length = send_or_write_wr.len(),
+                length = send_or_write_wr.sgl_len,
                 qpn = self.sqpn(),
                 src_qp = self.dqpn(),
                 wc_flags = EMPTY_WC_FLAG, # Requester side CQE no need to handle IBV_WC_WITH_IMM or IBV_WC_WITH_INV
@@ -1134,12 +1872,15 @@ class SQ:
 
     def check_timeout_and_retry(self):
         if self.oldest_sent_ts_ns is not None:
-            cur_ts_ns = time.time_ns()
+            cur_ts_ns = time.monotonic_ns()
             timeout_ns = Util.timeout_to_ns(self.timeout)
             if self.oldest_sent_ts_ns + timeout_ns < cur_ts_ns:
-                assert self.min_unacked_psn < self.sq_psn, 'when timeout there should have outstanding requests'
+                assert self.min_unacked_psn != self.sq_psn, 'when timeout there should have outstanding requests'
                 logging.info(f'SQ={self.sqpn()} detected timeout and retry from PSN={self.min_unacked_psn} to PSN={self.sq_psn} (not included)')
-                ssn_to_retry, _ = self.req_pkt_psn_wr_ssn_dict[self.min_unacked_psn]
+                if self.min_unacked_psn in self.req_pkt_ring:
+                    ssn_to_retry, _ = self.req_pkt_ring[self.min_unacked_psn]
+                else: # min_unacked_psn is a partial read response PSN
+                    ssn_to_retry = self.find_read_ctx(self.min_unacked_psn).read_ssn
                 self.retry_one_wr(ssn_to_retry, psn_begin_retry = self.min_unacked_psn, retry_type = OTHER_RETRY) # Only retry oldest WR
                 self.update_oldest_sent_ts(ack_or_timeout = True) # Update oldest_sent_ts when timeout retry
 
@@ -1150,9 +1891,34 @@ class SQ:
     def update_oldest_sent_ts(self, ack_or_timeout = False):
         if ack_or_timeout or self.oldest_sent_ts_ns is None:
             if self.min_unacked_psn != self.sq_psn: # There are unacked requests
-                self.oldest_sent_ts_ns = time.time_ns()
+                self.oldest_sent_ts_ns = time.monotonic_ns()
             else:
                 self.oldest_sent_ts_ns = None # No outstanding request
+            self.arm_retry_timer()
+
+    # The retransmit timer fires when oldest_sent_ts_ns times out
+    def arm_retry_timer(self):
+        if self.retry_timer is not None:
+            self.timer_wheel.cancel(self.retry_timer)
+            self.retry_timer = None
+        if self.rnr_timer is not None: # Re-armed when RNR wait timer expires
+            return
+        timeout_ns = Util.timeout_to_ns(self.timeout)
+        if self.oldest_sent_ts_ns is not None and timeout_ns >= 0: # Negative timeout means infinite
+            delay_ns = self.oldest_sent_ts_ns + timeout_ns - time.monotonic_ns()
+            self.retry_timer = self.timer_wheel.schedule(delay_ns, self.on_retry_timer)
+
+    def on_retry_timer(self):
+        self.retry_timer = None
+        self.check_timeout_and_retry() # Re-arm the timer if retried
+        if self.retry_timer is None:
+            self.arm_retry_timer() # Timer fired a bit early, not timeout yet
+
+    def rnr_retry_wr(self, rnr_wr_ssn, rnr_psn, retry_handler = None):
+        self.rnr_timer = None
+        if rnr_wr_ssn in self.outstanding_wr_ring: # The WR might be flushed while waiting
+            self.retry_one_wr(rnr_wr_ssn, psn_begin_retry = rnr_psn, retry_type = RNR_RETRY, retry_handler = retry_handler)
+        self.update_oldest_sent_ts(ack_or_timeout = True) # Restart retransmit timer after RNR retry
 
     # min_unacked_psn is updated in 2 cases:
     # - explicit ACK received
@@ -1161,15 +1927,31 @@ class SQ:
         if self.min_unacked_psn != min_unacked_psn:
             self.min_unacked_psn = min_unacked_psn
 
+    # Implicitly ACK WR by WR, only the last packet of each fully acked WR needs handling
     def coalesce_ack(self, psn_upper_limit): # psn_upper_limit not included
         assert Util.psn_compare(self.min_unacked_psn, psn_upper_limit, self.sq_psn) <= 0, 'min_unacked_psn shoud <= psn_upper_limit'
         implicit_ack_pkt_num = 0
-        for unacked_psn in Util.psn_range(self.min_unacked_psn, psn_upper_limit):
-            ack_res = self.ack_send_or_write_req(unacked_psn)
-            if not ack_res: # unacked_psn is either read or atomic request, coalesce ack should stop
+        unacked_psn = self.min_unacked_psn
+        while unacked_psn != psn_upper_limit:
+            if unacked_psn not in self.req_pkt_ring: # unacked_psn is a partial read response PSN
+                self.update_min_unacked_psn(min_unacked_psn = unacked_psn)
+                return (False, unacked_psn, implicit_ack_pkt_num) # coalesce_ack enountered implicit NAK
+            pending_wr_ssn, unacked_pkt = self.req_pkt_ring[unacked_psn]
+            rc_op = unacked_pkt[BTH].opcode
+            if rc_op == RC.RDMA_READ_REQUEST or RC.atomic(rc_op): # Coalesce ack should stop at read or atomic request
                 self.update_min_unacked_psn(min_unacked_psn = unacked_psn)
                 return (False, unacked_psn, implicit_ack_pkt_num) # coalesce_ack enountered implicit NAK
-            implicit_ack_pkt_num += 1
+
+            wr_ctx = self.outstanding_wr_ring[pending_wr_ssn]
+            wr_end_psn = (wr_ctx.first_pkt_psn + wr_ctx.req_pkt_num) % MAX_PSN # Not included
+            if Util.psn_compare(wr_end_psn, psn_upper_limit, self.sq_psn) <= 0: # The whole WR is acked
+                ack_res = self.ack_send_or_write_req(Util.previous_psn(wr_end_psn))
+                assert ack_res, 'should successfully ack send or write request'
+                acked_psn = wr_end_psn
+            else: # The WR is partially acked
+                acked_psn = psn_upper_limit
+            implicit_ack_pkt_num += (acked_psn - unacked_psn) % MAX_PSN
+            unacked_psn = acked_psn
         self.update_min_unacked_psn(min_unacked_psn = psn_upper_limit)
         return (True, psn_upper_limit, implicit_ack_pkt_num) # coalesce_ack success
 
@@ -1186,13 +1968,13 @@ class SQ:
             #self.coalesce_ack(ack[BTH].psn)
 
             # Explicitly NAK corresponding request
-            nak_ssn, ak_pkt = self.req_pkt_psn_wr_ssn_dict[ack[BTH].psn]
+            nak_ssn, ak_pkt = self.req_pkt_ring[ack[BTH].psn]
             nak_sr = self.get_outstanding_wr(nak_ssn)
             nak_cqe = CQE(
-                wr_id = nak_sr.id(),
+                wr_id = nak_sr.wr_id,
                 status = WC_STATUS.from_nak(ack[AETH].value),
-                opcode = WC_OPCODE.from_wr_op(nak_sr.id()),
-                length = nak_sr.len(),
+                opcode = WC_OPCODE.from_wr_op(nak_sr.opcode),
+                length = nak_sr.sgl_len,
                 qpn = self.sqpn(),
                 src_qp = self.dqpn(),
                 wc_flags = EMPTY_WC_FLAG,
@@ -1202,14 +1984,14 @@ class SQ:
 
             # All pending processing send WR will be completed with flush in error
             # Since current implementation is single-thread, this case does not matter
-            for pending_ssn, wr_ctx in self.outstanding_wr_dict.items():
+            for pending_ssn, wr_ctx in sorted(self.outstanding_wr_ring.items(), key = lambda item: (item[0] - self.ssn) % MAX_SSN): # In SSN order
                 pending_sr = wr_ctx.wr
                 rc_op = ak_pkt[BTH].opcode
                 flush_pending_cqe = CQE(
-                    wr_id = pending_sr.id(),
+                    wr_id = pending_sr.wr_id,
                     status = WC_STATUS.WR_FLUSH_ERR,
-                    opcode = WC_OPCODE.from_wr_op(pending_sr.id()),
-                    length = nak_sr.len(),
+                    opcode = WC_OPCODE.from_wr_op(pending_sr.opcode),
+                    length = pending_sr.sgl_len,
                     qpn = self.sqpn(),
                     src_qp = self.dqpn(),
                     wc_flags = EMPTY_WC_FLAG,
@@ -1217,19 +1999,18 @@ class SQ:
                 self.cq.push(flush_pending_cqe)
                 #self.rm_outstanding_wr(pending_ssn) BUG: cannot iterate a dictory and remove from it
             # Clear all pending WR, packets
-            self.outstanding_wr_dict.clear() # Delete all pending WR
-            self.req_pkt_psn_wr_ssn_dict.clear() # Delete all pending request data
-            self.read_resp_psn_wr_ssn_dict.clear() # Delete all pending read response data
+            self.outstanding_wr_ring.clear() # Delete all pending WR
+            self.req_pkt_ring.clear() # Delete all pending request data
             self.read_ctx_dict.clear() # Delete all pending read response context data
 
             # All submitted WR in SQ will be completed with flush in error
             while not self.empty():
                 flush_sr = self.pop()
                 flush_cqe = CQE(
-                    wr_id = flush_sr.id(),
+                    wr_id = flush_sr.wr_id,
                     status = WC_STATUS.WR_FLUSH_ERR,
-                    opcode = WC_OPCODE.from_wr_op(flush_sr.id()),
-                    length = flush_sr.len(),
+                    opcode = WC_OPCODE.from_wr_op(flush_sr.opcode),
+                    length = flush_sr.sgl_len,
                     qpn = self.sqpn(),
                     src_qp = self.dqpn(),
                     wc_flags = EMPTY_WC_FLAG,
@@ -1244,12 +2025,15 @@ class SQ:
                 self.min_rnr_timer # Choose the larger RNR timer
             logging.debug(f'SQ={self.sqpn()} received RNR NAK with PSN={rnr_psn} and wait time={rnr_wait_timer}, min_rnr_timer={self.min_rnr_timer}')
             # Handle RNR NAK wait time
-            wait_time_secs = Util.rnr_timer_to_ns(rnr_wait_timer) / 1_000_000_000
-            time.sleep(wait_time_secs) # Wait the time specified by rnr_wait_timer before retry
+            wait_time_ns = Util.rnr_timer_to_ns(rnr_wait_timer)
 
             # TODO: double check RNR retry only the specified request packet or retry all thereafter
-            rnr_wr_ssn, rnr_pkt = self.req_pkt_psn_wr_ssn_dict[rnr_psn]
-            self.retry_one_wr(rnr_wr_ssn, psn_begin_retry = rnr_psn, retry_type = RNR_RETRY, retry_handler = retry_handler)
+            rnr_wr_ssn, rnr_pkt = self.req_pkt_ring[rnr_psn]
+            # Do not block other QPs, retry when the RNR wait timer expires
+            if self.rnr_timer is not None:
+                self.timer_wheel.cancel(self.rnr_timer)
+            self.rnr_timer = self.timer_wheel.schedule(wait_time_ns, self.rnr_retry_wr, rnr_wr_ssn, rnr_psn, retry_handler)
+            self.arm_retry_timer() # Stop retransmit timer while waiting
             # if rc_op == RC.SEND_FIRST: # Retry whole send request
             #     send_wr = self.get_outstanding_wr(rnr_wr_ssn)
             #     assert send_wr.len() > self.pmtu, 'this RNR retried send request should have multiple packets'
@@ -1281,7 +2065,7 @@ class SQ:
             logging.debug(f'SQ={self.sqpn()} received NAK SEQ ERR with PSN={seq_err_psn}')
             self.retry_pkts(psn_begin_retry = seq_err_psn, retry_type = OTHER_RETRY, retry_handler= retry_handler) # retry remaining request if any
         else:
-            logging.info('received reserved AETH code or reserved AETH NAK value or unsported AETH NAK value: ' + ask.show(dump = True))
+            logging.info('received reserved AETH code or reserved AETH NAK value or unsported AETH NAK value: %s', PktTrace(ack))
         return False # No ACK-ed packet, do not update unacked_min_psn
 
     def handle_read_resp(self, read_resp):
@@ -1294,21 +2078,17 @@ class SQ:
 
         padding = read_resp[BTH].padcount
         read_resp_psn = read_resp[BTH].psn
-        read_wr_ssn, orig_read_req_psn = self.read_resp_psn_wr_ssn_dict[read_resp_psn]
+        read_ctx = self.find_read_ctx(read_resp_psn)
+        assert read_ctx is not None, 'read response PSN should be within an outstanding read response PSN range'
+        read_wr_ssn = read_ctx.read_ssn
         read_wr = self.get_outstanding_wr(read_wr_ssn)
-        read_offset, resp_pkt_psn_dict = self.read_ctx_dict[read_wr_ssn]
+        read_offset = read_ctx.resp_offset(read_resp_psn) # Retried read responses are written to the same place
 
-        read_dlen = read_wr.len()
-        read_laddr = read_wr.laddr()
+        read_dlen = read_wr.sgl_len
         if Raw in read_resp:
-            read_lkey = read_wr.lkey()
             # TODO: handle locally detected error: Length Error / Requester Class B
-            assert self.pd.validate_mr(rc_op, read_lkey, read_laddr, read_dlen), 'read response local access error'
-            read_mr = self.pd.get_mr(read_lkey)
-            read_mr.write(read_resp[Raw].load, addr = read_laddr + read_offset)
+            self.pd.scatter(rc_op, read_wr.sgl, read_offset, read_resp[Raw].load)
             read_offset += len(read_resp[Raw].load)
-        # Update read_ctx_dict
-        self.read_ctx_dict[read_wr_ssn] = (read_offset, resp_pkt_psn_dict)
 
         if rc_op == RC.RDMA_READ_RESPONSE_LAST or rc_op == RC.RDMA_READ_RESPONSE_ONLY:
             # TODO: handle locally detected error: Length error / Requester Class B
@@ -1316,7 +2096,7 @@ class SQ:
 
             # Generate CQE for read response
             read_cqe = CQE(
-                wr_id = read_wr.id(),
+                wr_id = read_wr.wr_id,
                 status = WC_STATUS.SUCCESS,
                 opcode = WC_OPCODE.from_rc_op(rc_op),
                 length = read_dlen,
@@ -1336,21 +2116,21 @@ class SQ:
         # TODO: handle atomic NAK, does atomic have NAK?
         assert atomic_ack[AETH].code == 0, 'atomic ack is NAK'
 
-        atomic_wr_ssn, atomic_req = self.req_pkt_psn_wr_ssn_dict[atomic_ack[BTH].psn]
+        atomic_wr_ssn, atomic_req = self.req_pkt_ring[atomic_ack[BTH].psn]
         atomic_wr = self.get_outstanding_wr(atomic_wr_ssn)
-        atomic_laddr = atomic_wr.laddr()
-        atomic_lkey = atomic_wr.lkey()
+        atomic_laddr = atomic_wr.sgl[0].pos_in_mr
+        atomic_lkey = atomic_wr.sgl[0].local_key
 
         # TODO: handle locally detected error: Local Memory Protection Error / Requester Class B
         assert self.pd.validate_mr(rc_op, atomic_lkey, atomic_laddr, ATOMIC_BYTE_SIZE), 'atomic response local access error'
-        # Because bind_layers(AETH, AtomicAckETH) is not work, so use Raw instead of AtomicAckETH
-        assert len(atomic_ack[Raw]) == ATOMIC_BYTE_SIZE, 'AtomicAckETH size not correct'
+        assert AtomicAckETH in atomic_ack, 'atomic ack should have AtomicAckETH'
         atomic_mr = self.pd.get_mr(atomic_lkey)
-        atomic_mr.write(byte_data = atomic_ack[Raw].load, addr = atomic_laddr)
+        # The original value is in host byte order, the same as how RQ.handle_atomic_req() reads it
+        atomic_mr.write(byte_data = atomic_ack[AtomicAckETH].orig.to_bytes(ATOMIC_BYTE_SIZE, sys.byteorder), addr = atomic_laddr)
         atomic_cqe = CQE(
-            wr_id = atomic_wr.id(),
+            wr_id = atomic_wr.wr_id,
             status = WC_STATUS.SUCCESS,
-            opcode = WC_OPCODE.from_wr_op(atomic_wr.op()),
+            opcode = WC_OPCODE.from_wr_op(atomic_wr.opcode),
             length = ATOMIC_BYTE_SIZE,
             qpn = self.sqpn(),
             src_qp = self.dqpn(),
@@ -1362,8 +2142,65 @@ class SQ:
         self.rm_outstanding_wr(atomic_wr_ssn)
         return True # Should update unacked_min_psn
 
+class AsyncEvent:
+    def __init__(self, event_type, element):
+        self.event_type = event_type
+        self.event_element = element # The QP, CQ or SRQ of the event
+
+    def type(self):
+        return self.event_type
+
+    def element(self):
+        return self.event_element
+
+# Receive WRs shared by the RQs of multiple QPs
+class SRQ:
+    def __init__(self, pd, srqn, async_event_list,
+        max_wr = DEFAULT_MAX_SRQ_WR,
+        max_sge = DEFAULT_MAX_SGE,
+        srq_limit = 0,
+    ):
+        self.pd = pd
+        self.srq_num = srqn
+        self.async_event_list = async_event_list
+        self.max_wr = max_wr
+        self.max_sge = max_sge
+        self.srq_limit = srq_limit # 0 means the limit is not armed
+        self.rq = collections.deque()
+
+    def srqn(self):
+        return self.srq_num
+
+    # Arm the limit, SRQ_LIMIT_REACHED is generated once when receive WRs in SRQ drop below it
+    def modify(self, srq_limit):
+        assert srq_limit <= self.max_wr, 'SRQ limit should not exceed max WR number'
+        self.srq_limit = srq_limit
+
+    def push(self, wr):
+        # TODO: handle immediate error
+        assert len(self.rq) < self.max_wr, 'SRQ is full'
+        assert len(wr.sgl) <= self.max_sge, 'receive WR has too many SGEs'
+        self.rq.append(wr)
+
+    def pop(self):
+        wr = self.rq.popleft()
+        if len(self.rq) < self.srq_limit:
+            logging.debug(f'SRQ={self.srqn()} has {len(self.rq)} receive WRs, below limit={self.srq_limit}')
+            self.srq_limit = 0 # The limit must be armed again
+            self.async_event_list.append(AsyncEvent(EVENT_TYPE.SRQ_LIMIT_REACHED, self))
+        return wr
+
+    def top(self):
+        return self.rq[0]
+
+    def empty(self):
+        return not bool(self.rq)
+
+    def size(self):
+        return len(self.rq)
+
 class RQ:
-    def __init__(self, pd, cq, sq, qpn, rq_psn, pmtu, access_flags, use_ipv6,
+    def __init__(self, pd, cq, sq, qpn, rq_psn, pmtu, access_flags, tx, timer_wheel,
         pkey = DEFAULT_PKEY,
         max_rd_atomic = 10,
         max_dest_rd_atomic = 10,
@@ -1371,8 +2208,15 @@ class RQ:
         timeout = 10,
         retry_cnt = 3,
         rnr_retry = 3,
+        max_recv_sge = DEFAULT_MAX_SGE,
+        srq = None,
+        qp_type = QPT.RC,
     ):
         self.rq = []
+        self.qp_type = qp_type
+        self.transport = {QPT.RC: TRANSPORT_RC, QPT.UC: TRANSPORT_UC, QPT.UD: TRANSPORT_UD}[qp_type]
+        self.max_recv_sge = max_recv_sge
+        self.srq = srq # Receive WRs are taken from SRQ if not None
         self.qps = QPS.INIT
         self.pd = pd # TODO: check pd match for each req
         self.cq = cq
@@ -1386,6 +2230,7 @@ class RQ:
         self.dst_qpn = None
         self.access_flags = access_flags
         self.pkey = pkey
+        self.qkey = DEFAULT_QKEY # UD only
         self.max_rd_atomic = max_rd_atomic
         self.max_dest_rd_atomic = max_dest_rd_atomic
         self.min_rnr_timer = min_rnr_timer
@@ -1393,14 +2238,23 @@ class RQ:
         self.retry_cnt = retry_cnt
         self.rnr_retry = rnr_retry
 
-        self.use_ipv6 = use_ipv6
+        self.tx = tx
+        self.tx_flow = None
         self.resp_pkt_dict = {}
         self.pre_pkt_op = None
 
         self.cur_send_req_ctx = None
         self.cur_write_req_ctx = None
 
-        self.rnr_nak_wait_clear_ts_ns = 0
+        # Coalesce ACKs, up to ack_coalesce_pkts requests asking for ACK or ack_coalesce_us
+        self.ack_coalesce_pkts = DEFAULT_ACK_COALESCE_PKTS
+        self.ack_coalesce_us = DEFAULT_ACK_COALESCE_US
+        self.pending_ack_psn = None # The PSN of the latest request asking for ACK, but not ACK-ed yet
+        self.pending_ack_req_num = 0
+        self.ack_timer = None
+
+        self.timer_wheel = timer_wheel
+        self.rnr_nak_wait_timer = None # Not None when RNR NAK wait timer is not cleared
         self.nak_seq_err_clear = True
 
     def modify(self,
@@ -1408,9 +2262,11 @@ class RQ:
         pmtu = None,
         rq_psn = None,
         dgid = None,
+        tx_flow = None,
         dst_qpn = None,
         access_flags = None,
         pkey = None,
+        qkey = None,
         sq_draining = None,
         max_rd_atomic = None,
         max_dest_rd_atomic = None,
@@ -1418,6 +2274,8 @@ class RQ:
         timeout = None,
         retry_cnt = None,
         rnr_retry = None,
+        ack_coalesce_pkts = None,
+        ack_coalesce_us = None,
     ):
         if qps is not None:
             self.qps = qps
@@ -1427,12 +2285,16 @@ class RQ:
             self.rq_psn = rq_psn % MAX_PSN
         if dgid is not None:
             self.dgid = dgid
+        if tx_flow is not None:
+            self.tx_flow = tx_flow # The destination resolved from dgid
         if dst_qpn is not None:
             self.dst_qpn = dst_qpn # qpn in number instread of hex string
         if access_flags is not None:
             self.access_flags = access_flags
         if pkey is not None:
             self.pkey = pkey
+        if qkey is not None:
+            self.qkey = qkey
         if sq_draining is not None:
             self.sq_draining = sq_draining
         if max_rd_atomic is not None:
@@ -1447,17 +2309,31 @@ class RQ:
             self.retry_cnt = retry_cnt
         if rnr_retry is not None:
             self.rnr_retry = rnr_retry
+        if ack_coalesce_pkts is not None:
+            assert ack_coalesce_pkts > 0, 'ack_coalesce_pkts should be positive'
+            self.ack_coalesce_pkts = ack_coalesce_pkts
+        if ack_coalesce_us is not None:
+            self.ack_coalesce_us = ack_coalesce_us
 
     def push(self, wr):
+        # TODO: handle immediate error
+        assert self.srq is None, 'QP with SRQ should post receive WR to SRQ'
+        assert len(wr.sgl) <= self.max_recv_sge, 'receive WR has too many SGEs'
         self.rq.append(wr)
 
     def pop(self):
+        if self.srq is not None:
+            return self.srq.pop()
         return self.rq.pop(0)
 
     def top(self):
+        if self.srq is not None:
+            return self.srq.top()
         return self.rq[0]
 
     def empty(self):
+        if self.srq is not None:
+            return self.srq.empty()
         return not bool(self.rq)
 
     def sqpn(self):
@@ -1477,52 +2353,54 @@ class RQ:
         psn_comp_res = Util.psn_compare(self.rq_psn, req_psn, self.rq_psn)
         assert psn_comp_res != 0, 'should handle duplicate or illegal request'
         if psn_comp_res > 0: # Dup req
-            logging.debug(f'RQ={self.sqpn()} received duplicate request: ' + req.show(dump = True))
+            logging.debug('RQ=%s received duplicate request: %s', self.sqpn(), PktTrace(req))
             rc_op = req[BTH].opcode
             if RC.send(rc_op) or RC.write(rc_op):
-                dup_resp = self.resp_pkt_dict[req_psn]
-                dup_resp[BTH].psn = self.rq_psn # Dup requst response has latest PSN
-                self.send_pkt(dup_resp, save_pkt = False)
+                # ACKs might be coalesced, so ACK the duplicate request itself, and the last packet
+                # of a message is always ACK-ed, in case the requester retried it without ACK request
+                if req[BTH].ackreq or RC.last_req_pkt(rc_op) or RC.only_req_pkt(rc_op):
+                    self.send_pkt(self.build_ack(req_psn), save_pkt = False)
             elif rc_op == RC.RDMA_READ_REQUEST:
-                self.handle_read_req(self, req, update_epsn = False)
+                self.handle_read_req(req, update_epsn = False)
             elif RC.atomic(rc_op):
                 # TODO: check the dup atomic request is the same as before
                 dup_resp = self.resp_pkt_dict[req_psn]
                 if AtomicAckETH in dup_resp:
                     self.send_pkt(dup_resp, save_pkt = False)
                 else:
-                    logging.debug(f'RQ={self.sqpn()} received duplicate atomic request: ' + req.show(dump = True) + ', but the response was not match: ' + dup_resp.show(dump = True))
+                    logging.debug('RQ=%s received duplicate atomic request: %s, but the response was not match: %s', self.sqpn(), PktTrace(req), PktTrace(dup_resp))
         else:
             # Handle NAK sequence error: Out of Sequence Request Packet / Responder Class B
-            logging.debug(f'RQ={self.sqpn()} had sequence error, ePSN={self.rq_psn} but received request: ' + req.show(dump = True))
+            logging.debug('RQ=%s had sequence error, ePSN=%s but received request: %s', self.sqpn(), self.rq_psn, PktTrace(req))
             self.process_nak_seq_err()
 
     def send_pkt(self, resp, save_pkt = True):
         if not self.dqpn():
             raise Exception(f'RQ={self.sqpn()} has no destination QPN')
-        elif not self.dgid:
+        elif not self.tx_flow:
             raise Exception(f'RQ={self.sqpn()} has no destination GID')
 
-        #dst_ipv6 = socket.inet_ntop(socket.AF_INET6, bytes.fromhex(self.dgid))
-        dst_ipv6 = socket.inet_ntop(socket.AF_INET6, self.dgid)
-        dst_ipv4 = dst_ipv6.replace('::ffff:', '')
-        dst_ip = dst_ipv6 if self.use_ipv6 else dst_ipv4
-
-        pkt = IP(dst=dst_ip)/UDP(dport=ROCE_PORT, sport=self.sqpn())/resp
-        cpsn = pkt[BTH].psn
+        if self.pending_ack_psn is not None:
+            self.flush_ack() # Responses are in PSN order, the coalesced ACK goes first
+        cpsn = resp[BTH].psn
         if save_pkt:
-            self.resp_pkt_dict[cpsn] = pkt
-        logging.debug(f'RQ={self.sqpn()} send to IP={dst_ip} a response: ' + pkt.show(dump = True))
-        send(pkt)
-
-    def recv_pkt(self, pkt, retry_handler = None):
-        logging.debug(f'RQ={self.sqpn()} received packet with length={len(pkt)}: ' + pkt.show(dump = True) + f', previous operation is: {self.pre_pkt_op}')
-        rc_op = pkt[BTH].opcode
+            self.resp_pkt_dict[cpsn] = resp
+        logging.debug('RQ=%s send to IP=%s a response: %s', self.sqpn(), self.tx_flow.dst_ip(), PktTrace(resp))
+        self.tx.send(self.tx_flow, resp)
 
+    # src_addr is the sender IP and port, only used by UD
+    def recv_pkt(self, pkt, retry_handler = None, src_addr = None):
+        logging.debug('RQ=%s received packet with length=%s: %s, previous operation is: %s', self.sqpn(), len(pkt), PktTrace(pkt), self.pre_pkt_op)
         # TODO: handle head verification
         assert pkt[BTH].dqpn == self.qpn, 'received packet QPN not match'
-        assert pkt[BTH].opcode < 0x20, 'only RC supported'
+        assert (pkt[BTH].opcode & ~OPCODE_MASK) == self.transport, 'received packet transport not match QP type'
         assert pkt[BTH].version == 0, 'header version must be zero'
+        pkt[BTH].opcode &= OPCODE_MASK
+        rc_op = pkt[BTH].opcode
+        if self.qp_type == QPT.UC:
+            return self.recv_uc_pkt(pkt)
+        elif self.qp_type == QPT.UD:
+            return self.recv_ud_pkt(pkt, src_addr)
 
         # TODO: handle invalid request error: Out of Sequence OpCode / Responder Class C
         assert Util.check_pre_cur_ops(self.pre_pkt_op, rc_op), 'previous and current opcodes are not legal'
@@ -1559,6 +2437,95 @@ class RQ:
         else:
             raise Exception(f'unsupported opcode={rc_op}')
 
+    def recv_uc_pkt(self, pkt):
+        rc_op = pkt[BTH].opcode
+        # TODO: handle invalid request, UC silently drops it
+        assert RC.send(rc_op) or RC.write(rc_op), 'UC only supports send and write'
+        assert Util.check_pkt_size(self.pmtu, pkt), 'received packet size illegal'
+        assert Util.check_op_with_access_flags(rc_op, self.access_flags), 'received packet has opcode without proper permission'
+
+        if not self.is_expected_req(pkt[BTH].psn):
+            # PSN gap, drop the partial message and resync ePSN
+            logging.debug('RQ=%s had sequence error, ePSN=%s but received request: %s', self.sqpn(), self.rq_psn, PktTrace(pkt))
+            self.abort_uc_msg()
+            self.rq_psn = pkt[BTH].psn
+        if (RC.mid_req_pkt(rc_op) or RC.last_req_pkt(rc_op)) and self.cur_send_req_ctx is None and self.cur_write_req_ctx is None:
+            # The rest of a dropped message, wait for the next first or only packet
+            logging.debug('RQ=%s dropped request of an aborted message: %s', self.sqpn(), PktTrace(pkt))
+            self.rq_psn = (self.rq_psn + 1) % MAX_PSN
+            return
+
+        # TODO: handle invalid request error: Out of Sequence OpCode
+        assert Util.check_pre_cur_ops(self.pre_pkt_op, rc_op), 'previous and current opcodes are not legal'
+        if RC.send(rc_op):
+            self.handle_send_req(pkt)
+        else:
+            self.handle_write_req(pkt)
+        # No previous operation if the message is finished or dropped
+        self.pre_pkt_op = rc_op if self.cur_send_req_ctx is not None or self.cur_write_req_ctx is not None else None
+
+    # UD receives single packet messages from any QP, there is no PSN check, ACK or RNR NAK,
+    # the receive buffer starts with the GRH, followed by the data
+    def recv_ud_pkt(self, pkt, src_addr):
+        rc_op = pkt[BTH].opcode
+        # TODO: handle invalid request, UD silently drops it
+        assert rc_op in [RC.SEND_ONLY, RC.SEND_ONLY_WITH_IMMEDIATE], 'UD only supports send only'
+        assert Util.check_pkt_size(self.pmtu, pkt), 'received packet size illegal'
+
+        src_qpn = pkt[DETH].sqpn
+        if pkt[DETH].qkey != self.qkey:
+            logging.debug(f'RQ={self.sqpn()} dropped UD send request from QP={src_qpn} with mismatched Q_Key={pkt[DETH].qkey}')
+            return
+        if self.empty():
+            logging.debug(f'RQ={self.sqpn()} is empty, dropped UD send request from QP={src_qpn}')
+            return
+        rr = self.pop()
+
+        recv_data = b''
+        if Raw in pkt:
+            recv_data = pkt[Raw].load
+            if pkt[BTH].padcount: # The pad is not written to MR
+                recv_data = recv_data[: (len(recv_data) - pkt[BTH].padcount)]
+        recv_len = GRH_LEN + len(recv_data)
+        cqe_status = WC_STATUS.SUCCESS
+        if recv_len > rr.sgl_len:
+            # The receive WR is completed in error, but UD QP does not go to error state
+            logging.debug(f'RQ={self.sqpn()} has no enough buffer for UD send request from QP={src_qpn} with length={recv_len}')
+            cqe_status = WC_STATUS.LOC_LEN_ERR
+        else:
+            self.pd.scatter(rc_op, rr.sgl, 0, self.tx.recv_grh(src_addr[0], len(pkt)))
+            if recv_data:
+                self.pd.scatter(rc_op, rr.sgl, GRH_LEN, recv_data)
+
+        cqe_wc_flags = WC_FLAGS.GRH
+        cqe_imm_data_or_inv_rkey = None
+        if RC.has_imm(rc_op):
+            cqe_wc_flags |= WC_FLAGS.WITH_IMM
+            cqe_imm_data_or_inv_rkey = pkt[ImmDt].data
+        cqe = CQE(
+            wr_id = rr.wr_id,
+            status = cqe_status,
+            opcode = WC_OPCODE.from_rc_op(rc_op),
+            length = recv_len,
+            qpn = self.sqpn(),
+            src_qp = src_qpn,
+            wc_flags = cqe_wc_flags,
+            imm_data_or_inv_rkey = cqe_imm_data_or_inv_rkey,
+        )
+        self.cq.push(cqe, solicited = pkt[BTH].solicited)
+
+    def abort_uc_msg(self):
+        if self.cur_send_req_ctx is not None:
+            rr, send_offset = self.cur_send_req_ctx
+            # The receive WR of the aborted send is reused by the next message
+            if self.srq is not None:
+                self.srq.rq.appendleft(rr)
+            else:
+                self.rq.insert(0, rr)
+        self.cur_send_req_ctx = None
+        self.cur_write_req_ctx = None
+        self.pre_pkt_op = None
+
     def handle_send_req(self, send_req):
         rc_op = send_req[BTH].opcode
         assert RC.send(rc_op), 'should be send request'
@@ -1567,20 +2534,19 @@ class RQ:
         if RC.first_req_pkt(rc_op) or RC.only_req_pkt(rc_op):
             # Handle RNR NAK: Resources Not Ready Error / Responder Class B
             if self.empty():
+                if self.qp_type == QPT.UC: # No RNR NAK for UC, drop the message
+                    logging.debug(f'RQ={self.sqpn()} is empty, dropped UC send request')
+                    self.rq_psn = (self.rq_psn + 1) % MAX_PSN
+                    return
                 logging.debug(f'RQ={self.sqpn()} is empty, response RNR NAK to send request')
                 return self.process_nak_rnr(send_req)
             rr = self.pop()
             self.cur_send_req_ctx = (rr, 0)
 
         rr, send_offset = self.cur_send_req_ctx
-        send_addr = rr.addr() + send_offset
-        data_size = 0
         if Raw in send_req:
-            data_size = len(send_req[Raw].load)
             # TODO: handle invalid request error: Length errors / Responder Class C
-            assert self.pd.validate_mr(rc_op, rr.lkey(), send_addr, data_size), 'no enough receive buffer for send request'
-            send_mr = self.pd.get_mr(rr.lkey())
-            send_mr.write(send_req[Raw].load, addr = send_addr)
+            self.pd.scatter(rc_op, rr.sgl, send_offset, send_req[Raw].load)
             send_offset += len(send_req[Raw].load)
         self.cur_send_req_ctx = (rr, send_offset)
 
@@ -1599,7 +2565,7 @@ class RQ:
                 cqe_imm_data_or_inv_rkey = send_req[IETH].rkey # TODO: handle rkey invalidation
             # Generate CQE for received send request
             cqe = CQE(
-                wr_id = rr.id(),
+                wr_id = rr.wr_id,
                 status = WC_STATUS.SUCCESS,
                 opcode = WC_OPCODE.from_rc_op(rc_op),
                 length = send_offset,
@@ -1608,11 +2574,7 @@ class RQ:
                 wc_flags = cqe_wc_flags,
                 imm_data_or_inv_rkey = cqe_imm_data_or_inv_rkey,
             )
-            self.cq.push(cqe)
-
-            if send_req[BTH].solicited:
-                # TODO: handle solicited event
-                TODO
+            self.cq.push(cqe, solicited = send_req[BTH].solicited)
         self.rq_psn = (self.rq_psn + 1) % MAX_PSN # Update ePSN
         if send_req[BTH].ackreq:
             self.process_ack(send_req)
@@ -1645,8 +2607,11 @@ class RQ:
 
         write_mr, write_dlen, write_addr, write_offset = self.cur_write_req_ctx
         if Raw in write_req:
-            write_mr.write(write_req[Raw].load, addr = write_addr + write_offset)
-            write_offset += len(write_req[Raw].load)
+            write_load = write_req[Raw].load
+            if write_req[BTH].padcount: # The pad is not written to MR
+                write_load = write_load[: (len(write_load) - write_req[BTH].padcount)]
+            write_mr.write(write_load, addr = write_addr + write_offset)
+            write_offset += len(write_load)
         # Update write_offset to cur_write_req_ctx
         self.cur_write_req_ctx = (write_mr, write_dlen, write_addr, write_offset)
 
@@ -1662,12 +2627,16 @@ class RQ:
                 cqe_imm_data = write_req[RETHImmDt].data
                 # Handle RNR NAK: Resources Not Ready Error / Responder Class B
                 if self.empty():
+                    if self.qp_type == QPT.UC: # No RNR NAK for UC, drop the completion
+                        logging.debug(f'RQ={self.sqpn()} is empty, dropped UC write with immediate data completion')
+                        self.rq_psn = (self.rq_psn + 1) % MAX_PSN
+                        return
                     logging.debug(f'RQ={self.sqpn()} is empty but write with immediate data needs to consume a receive WR')
                     return self.process_nak_rnr(write_req)
                 rr = self.pop()
                 # Generate CQE for received send request
                 cqe = CQE(
-                    wr_id = rr.id(),
+                    wr_id = rr.wr_id,
                     status = WC_STATUS.SUCCESS,
                     opcode = WC_OPCODE.from_rc_op(rc_op),
                     length = write_dlen,
@@ -1676,11 +2645,7 @@ class RQ:
                     wc_flags = cqe_wc_flags,
                     imm_data_or_inv_rkey = cqe_imm_data,
                 )
-                self.cq.push(cqe)
-
-                if write_req[BTH].solicited:
-                    # TODO: handle solicited event
-                    TODO
+                self.cq.push(cqe, solicited = write_req[BTH].solicited)
         self.rq_psn = (self.rq_psn + 1) % MAX_PSN # Update ePSN
         if write_req[BTH].ackreq:
             self.process_ack(write_req)
@@ -1693,35 +2658,38 @@ class RQ:
         read_req_addr = read_req[RETH].va
         read_req_rkey = read_req[RETH].rkey
 
-        read_data = None
+        read_mr = None
         if read_req_size > 0:
             # TODO: handle remote access error: Responder Class C
             assert self.pd.validate_mr(rc_op, read_req_rkey, read_req_addr, read_req_size), 'read request remote access error'
             read_mr = self.pd.get_mr(read_req_rkey)
-            read_data = read_mr.read(addr = read_req_addr, size = read_req_size)
+        # Read MR per response packet, so a large read request never materializes the whole data
+        def read_resp_data(resp_idx):
+            resp_offset = resp_idx * self.pmtu
+            return read_mr.read(addr = read_req_addr + resp_offset, size = min(self.pmtu, read_req_size - resp_offset))
 
-        cpsn = self.rq_psn
+        cpsn = read_req[BTH].psn # Not ePSN for duplicate read request
         dqpn = self.dqpn()
         self.msn = (self.msn + 1) % MAX_MSN
         read_resp_pkt_num = math.ceil(read_req_size / self.pmtu) if read_req_size > 0 else 1
-        read_aeth = AETH(code = 'ACK', value = CREDIT_CNT_INVALID, msn = self.msn)
+        read_aeth = AETH(code = 'ACK', value = self.credit_cnt(), msn = self.msn)
         if read_resp_pkt_num > 1:
             read_resp_bth = BTH(
                 opcode = RC.RDMA_READ_RESPONSE_FIRST,
                 psn = cpsn,
                 dqpn = dqpn,
             )
-            read_resp = read_resp_bth/read_aeth/Raw(load = read_data[0 : self.pmtu])
+            read_resp = read_resp_bth/read_aeth/Raw(load = read_resp_data(0))
             self.send_pkt(read_resp, save_pkt = False)
 
             read_resp_mid_pkt_num = read_resp_pkt_num - 2
             for i in range(read_resp_mid_pkt_num):
                 read_resp_bth = BTH(
                     opcode = RC.RDMA_READ_RESPONSE_MIDDLE,
-                    psn = cpsn + i + 1,
+                    psn = (cpsn + i + 1) % MAX_PSN,
                     dqpn = dqpn,
                 )
-                read_resp = read_resp_bth/Raw(load = read_data[((i + 1) * self.pmtu) : ((i + 2) * self.pmtu)])
+                read_resp = read_resp_bth/Raw(load = read_resp_data(i + 1))
                 self.send_pkt(read_resp, save_pkt = False)
 
         rc_op = None
@@ -1731,12 +2699,12 @@ class RQ:
             rc_op = RC.RDMA_READ_RESPONSE_LAST
         read_resp_bth = BTH(
             opcode = rc_op,
-            psn = cpsn + read_resp_pkt_num - 1,
+            psn = (cpsn + read_resp_pkt_num - 1) % MAX_PSN,
             dqpn = dqpn,
         )
         read_resp = read_resp_bth/read_aeth
         if read_req_size > 0:
-            read_resp = read_resp/Raw(load = read_data[((read_resp_pkt_num - 1) * self.pmtu) : read_req_size])
+            read_resp = read_resp/Raw(load = read_resp_data(read_resp_pkt_num - 1))
         self.send_pkt(read_resp, save_pkt = False)
         if update_epsn:
             self.rq_psn = (self.rq_psn + read_resp_pkt_num) % MAX_PSN
@@ -1771,26 +2739,54 @@ class RQ:
             psn = cpsn,
             dqpn = dqpn,
         )
-        ack_aeth = AETH(code = 'ACK', value = CREDIT_CNT_INVALID, msn = self.msn)
+        ack_aeth = AETH(code = 'ACK', value = self.credit_cnt(), msn = self.msn)
         atomic_ack_eth = AtomicAckETH(orig = orig)
         atomic_ack = ack_bth/ack_aeth/atomic_ack_eth
         self.send_pkt(atomic_ack)
         self.rq_psn = (self.rq_psn + 1) % MAX_PSN # Update ePSN
 
-    def process_ack(self, req):
-        assert req[BTH].ackreq, 'received request should ask for ack response'
+    # The available receive WQE in log-scale, rounded down, SRQ is shared by QPs so it has no credit
+    def credit_cnt(self):
+        if self.srq is not None:
+            return CREDIT_CNT_INVALID
+        return bisect.bisect_right(AETH_CREDIT_TABLE, len(self.rq)) - 1
+
+    def build_ack(self, ack_psn):
         ack_bth = BTH(
             opcode = RC.ACKNOWLEDGE,
-            psn = req[BTH].psn,
+            psn = ack_psn,
             dqpn = self.dqpn(),
         )
-        # TODO: support RQ flow control
-        ack = ack_bth/AETH(code = 'ACK', value = CREDIT_CNT_INVALID, msn = self.msn)
-        self.send_pkt(ack)
+        return ack_bth/AETH(code = 'ACK', value = self.credit_cnt(), msn = self.msn)
+
+    # An ACK also ACKs all requests before it, so ACK requests are coalesced until
+    # ack_coalesce_pkts of them are pending or the oldest one waits ack_coalesce_us
+    def process_ack(self, req):
+        assert req[BTH].ackreq, 'received request should ask for ack response'
+        self.pending_ack_psn = req[BTH].psn
+        self.pending_ack_req_num += 1
+        if self.pending_ack_req_num >= self.ack_coalesce_pkts:
+            self.flush_ack()
+        elif self.ack_timer is None:
+            self.ack_timer = self.timer_wheel.schedule(self.ack_coalesce_us * 1000, self.on_ack_timer)
+
+    def on_ack_timer(self):
+        self.ack_timer = None
+        self.flush_ack()
+
+    def flush_ack(self):
+        if self.ack_timer is not None:
+            self.timer_wheel.cancel(self.ack_timer)
+            self.ack_timer = None
+        if self.pending_ack_psn is None:
+            return
+        ack = self.build_ack(self.pending_ack_psn)
+        self.pending_ack_psn = None
+        self.pending_ack_req_num = 0
+        self.send_pkt(ack, save_pkt = False) # Duplicate requests are ACK-ed by build_ack()
 
     def process_nak_rnr(self, req):
-        cur_ts_ns = time.time_ns()
-        if cur_ts_ns > self.rnr_nak_wait_clear_ts_ns:
+        if self.rnr_nak_wait_timer is None:
             rnr_wait_timer = self.min_rnr_timer
             rnr_nak_bth = BTH(
                 opcode = RC.ACKNOWLEDGE,
@@ -1800,10 +2796,13 @@ class RQ:
             rnr_nak_aeth = AETH(code = 'RNR', value = rnr_wait_timer, msn = self.msn)
             rnr_nak = rnr_nak_bth/rnr_nak_aeth
             self.send_pkt(rnr_nak)
-            self.rnr_nak_wait_clear_ts_ns = cur_ts_ns + Util.rnr_timer_to_ns(rnr_wait_timer) # The timestamp RNR NAK wait timer to be cleared
+            self.rnr_nak_wait_timer = self.timer_wheel.schedule(Util.rnr_timer_to_ns(rnr_wait_timer), self.clear_rnr_nak_wait)
         else:
             logging.info(f'RQ={self.sqpn()} already responsed a RNR NAK and its wait timer is not cleared, no RNR NAK to response again')
 
+    def clear_rnr_nak_wait(self):
+        self.rnr_nak_wait_timer = None
+
     def process_nak_seq_err(self):
         if self.nak_seq_err_clear:
             seq_nak_bth = BTH(
@@ -1819,7 +2818,7 @@ class RQ:
             logging.info(f'RQ={self.sqpn()} already responsed a NAK sequence error, and now it can only response to request matches its ePSN')
 
 class QP:
-    def __init__(self, pd, cq, qpn, pmtu, access_flags, use_ipv6,
+    def __init__(self, pd, cq, qpn, pmtu, access_flags, tx, timer_wheel,
         rq_psn = 0,
         sq_psn = 0,
         pkey = DEFAULT_PKEY,
@@ -1830,8 +2829,16 @@ class QP:
         timeout = 10,
         retry_cnt = 3,
         rnr_retry = 3,
+        max_send_sge = DEFAULT_MAX_SGE,
+        max_recv_sge = DEFAULT_MAX_SGE,
+        max_inline_data = DEFAULT_MAX_INLINE_DATA,
+        srq = None,
+        qp_type = QPT.RC,
     ):
         self.cq = cq
+        self.qp_type = qp_type
+        self.tx = tx
+        self.port_pmtu = pmtu
         self.sq = SQ(
             pd = pd,
             cq = cq,
@@ -1839,7 +2846,8 @@ class QP:
             sq_psn = sq_psn,
             pmtu = pmtu,
             access_flags = access_flags,
-            use_ipv6 = use_ipv6,
+            tx = tx,
+            timer_wheel = timer_wheel,
             pkey = pkey,
             draining = sq_draining,
             max_rd_atomic = max_rd_atomic,
@@ -1848,6 +2856,9 @@ class QP:
             timeout = timeout,
             retry_cnt = retry_cnt,
             rnr_retry = rnr_retry,
+            max_send_sge = max_send_sge,
+            max_inline_data = max_inline_data,
+            qp_type = qp_type,
         )
         self.rq = RQ(
             pd = pd,
@@ -1857,7 +2868,8 @@ class QP:
             rq_psn = rq_psn,
             pmtu = pmtu,
             access_flags = access_flags,
-            use_ipv6 = use_ipv6,
+            tx = tx,
+            timer_wheel = timer_wheel,
             pkey = pkey,
             max_rd_atomic = max_rd_atomic,
             max_dest_rd_atomic = max_dest_rd_atomic,
@@ -1865,9 +2877,15 @@ class QP:
             timeout = timeout,
             retry_cnt = retry_cnt,
             rnr_retry = rnr_retry,
+            max_recv_sge = max_recv_sge,
+            srq = srq,
+            qp_type = qp_type,
         )
         pd.add_qp(self)
 
+        self.sq_event = None # Wake up the SQ task in asyncio mode
+        self.sq_task = None
+
     def modify_qp(self,
         qps = None,
         pmtu = None,
@@ -1877,6 +2895,7 @@ class QP:
         dst_qpn = None,
         access_flags = None,
         pkey = None,
+        qkey = None,
         sq_draining = None,
         max_rd_atomic = None,
         max_dest_rd_atomic = None,
@@ -1884,15 +2903,26 @@ class QP:
         timeout = None,
         retry_cnt = None,
         rnr_retry = None,
+        ackreq_freq = None,
+        ack_coalesce_pkts = None,
+        ack_coalesce_us = None,
     ):
+        tx_flow = None
+        if dgid is not None:
+            tx_flow = self.tx.resolve(dgid) # Resolve destination once, not per packet
+        if pmtu is not None:
+            # The path MTU cannot exceed the port active MTU
+            pmtu = min(PMTU(pmtu), self.port_pmtu)
         self.sq.modify(
             qps = qps,
             pmtu = pmtu,
             sq_psn = sq_psn,
             dgid = dgid,
+            tx_flow = tx_flow,
             dst_qpn = dst_qpn,
             access_flags = access_flags,
             pkey = pkey,
+            qkey = qkey,
             sq_draining = sq_draining,
             max_rd_atomic = max_rd_atomic,
             max_dest_rd_atomic = max_dest_rd_atomic,
@@ -1900,15 +2930,18 @@ class QP:
             timeout = timeout,
             retry_cnt = retry_cnt,
             rnr_retry = rnr_retry,
+            ackreq_freq = ackreq_freq,
         )
         self.rq.modify(
             qps = qps,
             pmtu = pmtu,
             rq_psn = rq_psn,
             dgid = dgid,
+            tx_flow = tx_flow,
             dst_qpn = dst_qpn,
             access_flags = access_flags,
             pkey = pkey,
+            qkey = qkey,
             sq_draining = sq_draining,
             max_rd_atomic = max_rd_atomic,
             max_dest_rd_atomic = max_dest_rd_atomic,
@@ -1916,15 +2949,28 @@ class QP:
             timeout = timeout,
             retry_cnt = retry_cnt,
             rnr_retry = rnr_retry,
+            ack_coalesce_pkts = ack_coalesce_pkts,
+            ack_coalesce_us = ack_coalesce_us,
         )
 
     def qpn(self):
         return self.sq.sqpn()
 
-    def recv_pkt(self, pkt, retry_handler):
-        self.rq.recv_pkt(pkt, retry_handler)
-
-    def poll_cq(self):
+    def recv_pkt(self, pkt, retry_handler, src_addr = None):
+        self.rq.recv_pkt(pkt, retry_handler, src_addr)
+
+    # Each packet comes with its sender address
+    def recv_pkts(self, pkts, retry_handler):
+        for pkt, src_addr in pkts:
+            self.rq.recv_pkt(pkt, retry_handler, src_addr)
+        if self.sq_event is not None:
+            self.sq_event.set() # Responses might unblock pending read/atomic requests
+
+    # Without max_entries, return one CQE or None as before,
+    # otherwise return a list of at most max_entries CQEs in one batch
+    def poll_cq(self, max_entries = None):
+        if max_entries is not None:
+            return self.cq.poll(max_entries)
         if not self.cq.empty():
             return self.cq.pop()
         else:
@@ -1932,27 +2978,162 @@ class QP:
 
     def post_send(self, send_wr):
         self.sq.push(send_wr)
+        if self.sq_event is not None:
+            self.sq_event.set()
 
     def post_recv(self, recv_wr):
         self.rq.push(recv_wr)
 
+    # Lock-step mode sends exactly one WR right after posting it, check before posting
+    # that the SQ is empty and not blocked by credit or outstanding read/atomic requests
+    def can_send(self, send_wr):
+        return self.sq.empty() and self.sq.can_process(send_wr)
+
     def process_one_sr(self):
-        self.sq.process_one()
+        return self.sq.process_one()
+
+    def start(self, loop):
+        self.sq_event = asyncio.Event()
+        self.sq_task = loop.create_task(self.drain_sq())
+
+    def stop(self):
+        if self.sq_task is not None:
+            self.sq_task.cancel()
+            self.sq_task = None
+        self.sq_event = None
+
+    # Send all posted WR, wait when SQ is empty or blocked by outstanding read/atomic requests
+    async def drain_sq(self):
+        while True:
+            await self.sq_event.wait()
+            self.sq_event.clear()
+            try:
+                while not self.sq.empty() and self.sq.process_one():
+                    await asyncio.sleep(0) # Let other QPs run between WRs
+            except Exception:
+                logging.exception(f'SQ={self.qpn()} failed to process send WR')
+
+class TxFlow:
+    def __init__(self, dst_addr, icrc_flow):
+        self.dst_addr = dst_addr
+        self.icrc_flow = icrc_flow
+
+    def dst_ip(self):
+        return self.dst_addr[0]
+
+# Address handle, the destination of UD send WR, a UD QP can send to any number of AH
+class AH:
+    def __init__(self, pd, dgid, tx_flow):
+        self.pd = pd
+        self.dgid = dgid
+        self.tx_flow = tx_flow # The destination resolved from dgid
+
+    def gid(self):
+        return self.dgid
+
+    def dst_ip(self):
+        return self.tx_flow.dst_ip()
+
+class TxEngine:
+    # Send serialized packets via the long-lived RoCE UDP socket, the kernel
+    # builds IP/UDP headers and the ICRC is computed from the cached flow
+    def __init__(self, roce_sock, use_ipv6):
+        self.roce_sock = roce_sock
+        self.use_ipv6 = use_ipv6
+        self.bind_ip, self.sport = roce_sock.getsockname()[:2]
+        self.icrc_engine = IcrcEngine()
+        self.src_ip_dict = {} # Destination IP -> source IP
+        self.loop = None # The asyncio event loop in asyncio mode
+        if not use_ipv6:
+            # Always set DF, then kernel uses IP ID 0 for unconnected UDP socket, both are part of ICRC
+            self.roce_sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+
+    def resolve(self, dgid):
+        dst_ipv6 = socket.inet_ntop(socket.AF_INET6, dgid)
+        dst_ipv4 = dst_ipv6.replace('::ffff:', '')
+        family = socket.AF_INET6 if self.use_ipv6 else socket.AF_INET
+        dst_ip = dst_ipv6 if self.use_ipv6 else dst_ipv4
+
+        src_ip = self.route_src_ip(dst_ip)
+        icrc_flow = self.icrc_engine.flow(
+            src_ip = socket.inet_pton(family, src_ip),
+            dst_ip = socket.inet_pton(family, dst_ip),
+            sport = self.sport,
+            dport = ROCE_PORT,
+            ip_flags = 0 if self.use_ipv6 else IP_FLAG_DF,
+        )
+        return TxFlow(dst_addr = (dst_ip, ROCE_PORT), icrc_flow = icrc_flow)
+
+    def route_src_ip(self, dst_ip):
+        if self.bind_ip not in ['0.0.0.0', '::']: # The socket always sends from its bound IP
+            return self.bind_ip
+        src_ip = self.src_ip_dict.get(dst_ip)
+        if src_ip is None:
+            # Connecting a UDP socket sends nothing, but finds the source IP to the destination
+            family = socket.AF_INET6 if self.use_ipv6 else socket.AF_INET
+            with socket.socket(family, socket.SOCK_DGRAM) as probe_sock:
+                probe_sock.connect((dst_ip, ROCE_PORT))
+                src_ip = probe_sock.getsockname()[0]
+            self.src_ip_dict[dst_ip] = src_ip
+        return src_ip
+
+    # The GRH of a packet received from src_ip, the local IP is the one routed back to src_ip
+    def recv_grh(self, src_ip, roce_len):
+        family = socket.AF_INET6 if self.use_ipv6 else socket.AF_INET
+        return encode_grh(
+            src_ip = socket.inet_pton(family, src_ip),
+            dst_ip = socket.inet_pton(family, self.route_src_ip(src_ip)),
+            roce_len = roce_len,
+            ip_flags = 0 if self.use_ipv6 else IP_FLAG_DF,
+        )
+
+    def send(self, tx_flow, roce_pkt):
+        # Gather headers, payload view and ICRC, without concatenating them
+        hdr_bytes, payload = roce_pkt.encode_parts()
+        icrc = tx_flow.icrc_flow.icrc(hdr_bytes, payload)
+        buf_list = [hdr_bytes, *payload.bufs, icrc] if type(payload) is Gather else [hdr_bytes, payload, icrc]
+        try:
+            self.roce_sock.sendmsg(buf_list, (), 0, tx_flow.dst_addr)
+        except BlockingIOError:
+            if self.loop is None: # Only in asyncio mode the socket is non-blocking, never drop lock-step sends
+                raise
+            logging.warning(f'dropped a RoCE packet to IP={tx_flow.dst_ip()} since socket send buffer is full, it will be retried')
+        except OSError as err:
+            # DF is always set, so a packet larger than the route MTU is not fragmented,
+            # drop it and let retransmit or RNR retry own the recovery as a lost packet
+            if err.errno != errno.EMSGSIZE:
+                raise
+            logging.warning(f'dropped a RoCE packet of size={sum(len(buf) for buf in buf_list)} to IP={tx_flow.dst_ip()} since it exceeds the route MTU, the QP PMTU should be reduced')
 
 class RoCEv2:
     def __init__(self, pmtu = PMTU.MTU_256, use_ipv6 = False, recv_timeout_secs = 1):
-        self.roce_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        roce_bind_addr = ('0.0.0.0', ROCE_PORT)
+        if use_ipv6:
+            self.roce_sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            roce_bind_addr = ('::', ROCE_PORT)
+        else:
+            self.roce_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            roce_bind_addr = ('0.0.0.0', ROCE_PORT)
         self.roce_sock.bind(roce_bind_addr)
-        self.pmtu = pmtu
+        self.tx = TxEngine(self.roce_sock, use_ipv6)
+        self.recv_buf_list = [bytearray(UDP_BUF_SIZE) for i in range(RECV_BATCH_SIZE)]
+        self.recv_view_list = [memoryview(recv_buf) for recv_buf in self.recv_buf_list]
+        self.recv_addr_list = [None] * RECV_BATCH_SIZE # The sender address of each receive buffer
+        self.pmtu = PMTU(pmtu) # The port active MTU, the max PMTU of each QP
         self.use_ipv6 = use_ipv6
         self.recv_timeout_secs = recv_timeout_secs
         self.cur_cqn = 0
         self.cur_pdn = 0
         self.cur_qpn = 2
+        self.cur_srqn = 0
         self.cq_dict = {}
         self.pd_dict = {}
         self.qp_dict = {}
+        self.srq_dict = {}
+        self.async_event_list = collections.deque()
+        self.loop = None # The asyncio event loop in asyncio mode
+        self.timer_wheel = TimerWheel() # Shared by all QPs
+        self.timer_handle = None # The event loop timer to advance timer_wheel in asyncio mode
+        self.timer_handle_ns = None
 
     def alloc_pd(self):
         pdn = self.cur_pdn
@@ -1961,30 +3142,189 @@ class RoCEv2:
         self.pd_dict[pdn] = pd
         return pd
 
-    def create_cq(self):
+    def create_srq(self, pd, max_wr = DEFAULT_MAX_SRQ_WR, max_sge = DEFAULT_MAX_SGE, srq_limit = 0):
+        srqn = self.cur_srqn
+        self.cur_srqn += 1
+        srq = SRQ(pd = pd, srqn = srqn, async_event_list = self.async_event_list, max_wr = max_wr, max_sge = max_sge, srq_limit = srq_limit)
+        pd.add_srq(srq)
+        self.srq_dict[srqn] = srq
+        return srq
+
+    def post_srq_recv(self, srq, recv_wr):
+        srq.push(recv_wr)
+
+    # Return the next async event or None
+    def get_async_event(self):
+        if self.async_event_list:
+            return self.async_event_list.popleft()
+        return None
+
+    def create_ah(self, pd, dgid):
+        return AH(pd = pd, dgid = dgid, tx_flow = self.tx.resolve(dgid))
+
+    def create_comp_channel(self):
+        return CompChannel()
+
+    def create_cq(self, cq_size = DEFAULT_CQ_SIZE, channel = None, array_backed = False):
         cqn = self.cur_cqn
         self.cur_cqn += 1
-        cq = CQ(cqn)
+        cq_class = ArrayCQ if array_backed else CQ
+        cq = cq_class(cqn, cq_size, channel, self.timer_wheel)
         self.cq_dict[cqn] = cq
         return cq
 
-    def create_qp(self, pd, cq, access_flags):
+    def poll_cq(self, cq, max_entries = 1):
+        return cq.poll(max_entries)
+
+    def req_notify_cq(self, cq, solicited_only = False):
+        cq.req_notify(solicited_only)
+
+    def modify_cq(self, cq, cq_count, cq_period_us):
+        cq.modify_moderation(cq_count, cq_period_us)
+
+    def create_qp(self, pd, cq, access_flags,
+        max_send_sge = DEFAULT_MAX_SGE,
+        max_recv_sge = DEFAULT_MAX_SGE,
+        max_inline_data = DEFAULT_MAX_INLINE_DATA,
+        srq = None,
+        qp_type = QPT.RC,
+    ):
+        assert qp_type in [QPT.RC, QPT.UC, QPT.UD], 'unsupported QP type'
         qpn = self.cur_qpn
         self.cur_qpn += 1
-        qp = QP(pd = pd, cq = cq, qpn = qpn, access_flags = access_flags, pmtu = self.pmtu, use_ipv6 = self.use_ipv6)
+        qp = QP(
+            pd = pd,
+            cq = cq,
+            qpn = qpn,
+            access_flags = access_flags,
+            pmtu = self.pmtu,
+            tx = self.tx,
+            timer_wheel = self.timer_wheel,
+            max_send_sge = max_send_sge,
+            max_recv_sge = max_recv_sge,
+            max_inline_data = max_inline_data,
+            srq = srq,
+            qp_type = qp_type,
+        )
         self.qp_dict[qpn] = qp
+        if self.loop is not None:
+            qp.start(self.loop)
         return qp
 
     def mtu(self):
         return self.pmtu
 
     def recv_pkts(self, npkt = 1, retry_handler = None):
-        for i in range(npkt):
+        recv_pkt_num = 0
+        while recv_pkt_num < npkt:
             # TODO: handle retry
-            self.roce_sock.settimeout(self.recv_timeout_secs)
-            roce_bytes, peer_addr = self.roce_sock.recvfrom(UDP_BUF_SIZE)
-            roce_pkt = BTH(roce_bytes)
-            # TODO: handle head verification, wrong QPN
-            local_qp = self.qp_dict[roce_pkt.dqpn]
-            local_qp.recv_pkt(roce_pkt, retry_handler)
+            recv_pkt_num += self.recv_pkts_batch(max_pkts = npkt - recv_pkt_num, retry_handler = retry_handler)
         logging.debug(f'received {npkt} RoCE packets')
+
+    # Wait for the first packet, then drain all queued packets without blocking,
+    # and dispatch them to each QP as a list, return the number of received packets
+    # Received packets are decoded in place from the reused receive buffers,
+    # so their payload is only valid until the next receive
+    def recv_pkts_batch(self, max_pkts = RECV_BATCH_SIZE, retry_handler = None):
+        assert self.loop is None, 'cannot explicitly receive packets in asyncio mode'
+        max_pkts = min(max_pkts, RECV_BATCH_SIZE)
+        recv_len_list = [self.wait_first_pkt()]
+        self.drain_recv_bufs(recv_len_list, max_pkts)
+        self.dispatch_pkts(recv_len_list, retry_handler)
+        logging.debug(f'received a batch of {len(recv_len_list)} RoCE packets')
+        return len(recv_len_list)
+
+    # Wait for a packet at most recv_timeout_secs, and fire expired timers while waiting
+    def wait_first_pkt(self):
+        deadline_ns = None
+        if self.recv_timeout_secs is not None:
+            deadline_ns = time.monotonic_ns() + int(self.recv_timeout_secs * 1_000_000_000)
+        while True:
+            self.timer_wheel.advance()
+            wake_ns = self.timer_wheel.next_expire_ns()
+            if deadline_ns is not None and (wake_ns is None or deadline_ns < wake_ns):
+                wake_ns = deadline_ns
+            wait_secs = None if wake_ns is None else max(wake_ns - time.monotonic_ns(), 1) / 1_000_000_000
+            # Wait with select() instead of a socket timeout, the socket stays blocking for lock-step sends
+            readable_list, _, _ = select.select([self.roce_sock], [], [], wait_secs)
+            if readable_list:
+                try:
+                    # MSG_TRUNC makes recvfrom_into() return the real packet length even if truncated
+                    recv_len, self.recv_addr_list[0] = self.roce_sock.recvfrom_into(self.recv_buf_list[0], UDP_BUF_SIZE, socket.MSG_DONTWAIT | socket.MSG_TRUNC)
+                    return recv_len
+                except BlockingIOError:
+                    pass # Spurious wakeup, wait again
+            elif deadline_ns is not None and time.monotonic_ns() >= deadline_ns:
+                raise socket.timeout('timed out')
+
+    # Receive queued packets into the remaining receive buffers without blocking
+    def drain_recv_bufs(self, recv_len_list, max_pkts):
+        try:
+            while len(recv_len_list) < max_pkts:
+                buf_idx = len(recv_len_list)
+                recv_len, self.recv_addr_list[buf_idx] = self.roce_sock.recvfrom_into(self.recv_buf_list[buf_idx], UDP_BUF_SIZE, socket.MSG_DONTWAIT | socket.MSG_TRUNC)
+                recv_len_list.append(recv_len)
+        except BlockingIOError:
+            pass # No more queued packets
+
+    def dispatch_pkts(self, recv_len_list, retry_handler = None):
+        qp_pkts_dict = {} # QPN -> received packets and their sender addresses in order
+        for recv_view, src_addr, recv_len in zip(self.recv_view_list, self.recv_addr_list, recv_len_list):
+            if recv_len > UDP_BUF_SIZE:
+                logging.error(f'dropped a truncated RoCE packet with length={recv_len}, larger than receive buffer size={UDP_BUF_SIZE}')
+                continue
+            roce_pkt = decode_pkt(recv_view[:recv_len])
+            # TODO: handle head verification, wrong QPN
+            qp_pkts_dict.setdefault(roce_pkt[BTH].dqpn, []).append((roce_pkt, src_addr))
+        for dqpn, roce_pkts in qp_pkts_dict.items():
+            self.qp_dict[dqpn].recv_pkts(roce_pkts, retry_handler)
+
+    # asyncio mode: the RoCE socket is registered with the running event loop,
+    # received packets are dispatched to QPs as they arrive, each QP sends its
+    # posted WR in its own task, and retransmit timers are driven by the loop
+    def start(self, loop = None, retry_handler = None):
+        assert self.loop is None, 'RoCEv2 already started in asyncio mode'
+        self.loop = loop or asyncio.get_running_loop()
+        self.roce_sock.setblocking(False)
+        self.tx.loop = self.loop
+        self.loop.add_reader(self.roce_sock.fileno(), self.on_readable, retry_handler)
+        self.timer_wheel.wakeup = self.wakeup_timers
+        self.run_timers()
+        for qp in self.qp_dict.values():
+            qp.start(self.loop)
+
+    # Back to lock-step mode
+    def stop(self):
+        assert self.loop is not None, 'RoCEv2 not started in asyncio mode'
+        self.loop.remove_reader(self.roce_sock.fileno())
+        self.timer_wheel.wakeup = None
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        for qp in self.qp_dict.values():
+            qp.stop()
+        self.roce_sock.setblocking(True)
+        self.tx.loop = None
+        self.loop = None
+
+    def on_readable(self, retry_handler = None):
+        recv_len_list = []
+        self.drain_recv_bufs(recv_len_list, RECV_BATCH_SIZE)
+        self.dispatch_pkts(recv_len_list, retry_handler)
+
+    # In asyncio mode, an event loop timer advances timer_wheel at its next expire time
+    def wakeup_timers(self, expire_ns):
+        if self.timer_handle is not None:
+            if self.timer_handle_ns <= expire_ns:
+                return
+            self.timer_handle.cancel()
+        self.timer_handle_ns = expire_ns
+        self.timer_handle = self.loop.call_later(max(expire_ns - time.monotonic_ns(), 0) / 1_000_000_000, self.run_timers)
+
+    # Fire expired timers, it is called automatically in asyncio mode or when waiting for packets
+    def run_timers(self):
+        self.timer_handle = None
+        self.timer_wheel.advance()
+        next_expire_ns = self.timer_wheel.next_expire_ns()
+        if self.loop is not None and next_expire_ns is not None:
+            self.wakeup_timers(next_expire_ns)
@@ -1,5 +1,5 @@
 import yaml
-from case import read_success, send_rnr_retry, send_sucess, write_success
+from case import multi_pkt_success, read_success, send_rnr_retry, send_sucess, send_uc_success, write_success
 from sys import argv
 from config import Configure
 
@@ -11,9 +11,11 @@ except ImportError:
 MANAGER_VERSION = '0.0.1'
 
 CASE_MAPPING = {
+    'multi_pkt_success': multi_pkt_success.MultiPktSuccess,
     'read_success': read_success.ReadSuccess,
     'send_rnr_retry': send_rnr_retry.SendRnrRetry,
     'send_success': send_sucess.SendSuccess,
+    'send_uc_success': send_uc_success.SendUcSuccess,
     'write_success': write_success.WriteSuccess,
 }
 
@@ -1,10 +1,10 @@
-from proto.message_pb2 import ConnectQpResponse, CreateCqResponse, CreateMrResponse, CreatePdResponse, CreateQpResponse, LocalCheckMemResponse, LocalRecvResponse, LocalWriteResponse, OpenDeviceResponce, QueryPortResponse, RecvPktResponse, RemoteReadRequest, RemoteSendResponse, RemoteWriteRequest, UnblockRetryResponse, VersionResponse, QueryGidResponse
+from proto.message_pb2 import ConnectQpResponse, CreateCqResponse, CreateQpRequest, CreateMrResponse, CreatePdResponse, CreateQpResponse, LocalCheckMemResponse, LocalRecvResponse, LocalWriteResponse, OpenDeviceResponce, QueryPortResponse, RecvPktResponse, RemoteReadRequest, RemoteSendResponse, RemoteWriteRequest, UnblockRetryResponse, VersionResponse, QueryGidResponse
 from proto.side_pb2_grpc import SideServicer, add_SideServicer_to_server
 from concurrent import futures
 import grpc
 from sys import argv
-from roce_enum import ACCESS_FLAGS, SEND_FLAGS, WR_OPCODE
-from roce_v2 import RecvWR, RoCEv2, SG, SendWR, QPS
+from roce_enum import ACCESS_FLAGS, QPT, SEND_FLAGS, WR_OPCODE
+from roce_v2 import DEFAULT_CQ_SIZE, RecvWR, RoCEv2, SG, SendWR, QPS
 from threading import Lock
 import time
 
@@ -19,6 +19,7 @@ qp_lock = Lock()
 qp_list = []
 retry_lock = Lock()
 retry_flag = False
+CQ_POLL_BATCH_SIZE = 16
 
 class SanitySide(SideServicer):
     def __init__(self, ip):
@@ -56,7 +57,8 @@ class SanitySide(SideServicer):
         return CreateMrResponse(addr=mr.va, len=mr.length, rkey=mr.remote_key, lkey=mr.local_key, mr_id=mr_id)
 
     def CreateCq(self, request, context):
-        cq = GLOBAL_ROCE.create_cq()
+        # cq_size is 0 if the request does not set it
+        cq = GLOBAL_ROCE.create_cq(cq_size = request.cq_size or DEFAULT_CQ_SIZE)
         cq_lock.acquire()
         cq_list.append(cq)
         cq_id = len(cq_list) - 1
@@ -67,7 +69,8 @@ class SanitySide(SideServicer):
     def CreateQp(self, request, context):
         pd = pd_list[request.pd_id]
         cq = cq_list[request.cq_id]
-        qp = GLOBAL_ROCE.create_qp(pd, cq, 15 | ACCESS_FLAGS.ZERO_BASED)
+        qp_type = QPT.UC if request.qp_type == CreateQpRequest.UC else QPT.RC
+        qp = GLOBAL_ROCE.create_qp(pd, cq, 15 | ACCESS_FLAGS.ZERO_BASED, qp_type = qp_type)
         qp_lock.acquire()
         qp_list.append(qp)
         qp_id = len(qp_list) - 1
@@ -97,24 +100,21 @@ class SanitySide(SideServicer):
         sg = SG(pos_in_mr = request.addr, length = request.len, lkey = request.lkey)
         sr = SendWR(opcode = WR_OPCODE.RDMA_READ, sgl = sg, send_flags=SEND_FLAGS.SIGNALED, rmt_va = request.remote_addr, rkey = request.remote_key)
         qp = qp_list[request.qp_id]
-        qp.post_send(sr)
-        qp.process_one_sr()
+        post_send_one(qp, sr)
         return RemoteReadRequest()
 
     def RemoteWrite(self, request, context):
         sg = SG(pos_in_mr = request.addr, length = request.len, lkey = request.lkey)
         sr = SendWR(opcode = WR_OPCODE.RDMA_WRITE, sgl = sg, send_flags=SEND_FLAGS.SIGNALED, rmt_va = request.remote_addr, rkey = request.remote_key)
         qp = qp_list[request.qp_id]
-        qp.post_send(sr)
-        qp.process_one_sr()
+        post_send_one(qp, sr)
         return RemoteWriteRequest()
 
     def RemoteSend(self, request, context):
         sg = SG(pos_in_mr = request.addr, length = request.len, lkey = request.lkey)
         sr = SendWR(opcode = WR_OPCODE.SEND, sgl = sg, send_flags=SEND_FLAGS.SIGNALED)
         qp = qp_list[request.qp_id]
-        qp.post_send(sr)
-        qp.process_one_sr()
+        post_send_one(qp, sr)
         return RemoteSendResponse()
     
     def RecvPkt(self, request, context):
@@ -122,12 +122,15 @@ class SanitySide(SideServicer):
         GLOBAL_ROCE.recv_pkts(1, retry_handler=retry_handler)
         if request.has_cqe:
             qp = qp_list[request.qp_id]
-            cqe = qp.poll_cq()
+            # Drain all CQEs in batches, not only the one expected
+            cqe_list = qp.poll_cq(max_entries = CQ_POLL_BATCH_SIZE)
+            while cqe_list:
+                cqe_list = qp.poll_cq(max_entries = CQ_POLL_BATCH_SIZE)
         return RecvPktResponse()
 
     def LocalCheckMem(self, request, context):
         mr = mr_list[request.mr_id]
-        read = mr.byte_data[request.offset: (request.offset + request.len)]
+        read = mr.read_bytes(addr = request.offset, size = request.len)
         return LocalCheckMemResponse(same = (bytearray(request.expected) == read))
 
     def LocalRecv(self, request, context):
@@ -145,6 +148,14 @@ class SanitySide(SideServicer):
     def QueryGid(self, request, context):
         return QueryGidResponse(gid_raw = b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xff' + bytes(map(int, self.ip.split('.'))))
 
+# Lock-step mode sends the WR right away, so do not queue a WR the SQ cannot send now,
+# otherwise it would be sent by a later request instead of that request's own WR
+def post_send_one(qp, sr):
+    if not qp.can_send(sr):
+        raise Exception(f'QP={qp.qpn()} cannot send WR now, it is blocked by end-to-end credit or outstanding read/atomic requests')
+    qp.post_send(sr)
+    qp.process_one_sr()
+
 def default_retry_handler():
     global retry_flag, retry_lock
     print("Block")
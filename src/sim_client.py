@@ -204,7 +204,7 @@ print(struct.unpack('<i', exch_data))
 
 # RoCE atomic and ack
 roce.recv_pkts(1)
-print(mr.read(addr = 0, size = 24))
+print(mr.read_bytes(addr = 0, size = 24))
 
 # Exchange atomic done
 exch_data, peer_addr = udp_sock.recvfrom(UDP_BUF_SIZE)